@@ -1,4 +1,5 @@
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 
@@ -7,7 +8,7 @@ from sklearn.metrics.pairwise import (
     pairwise_distances,
     pairwise_distances_argmin,
 )
-from sklearn.utils import check_array, check_random_state
+from sklearn.utils import check_array
 from sklearn.utils.extmath import stable_cumsum
 from sklearn.utils.validation import check_is_fitted
 from sklearn.exceptions import ConvergenceWarning
@@ -40,10 +41,6 @@ class KMedoids(BaseEstimator, ClusterMixin, TransformerMixin):
     max_iter : int, optional, default : 300
         Specify the maximum number of iterations when fitting.
 
-    random_state : int, RandomState instance or None, optional
-        Specify random state for the random number generator. Used to
-        initialise medoids when init='random'.
-
     Attributes
     ----------
     cluster_centers_ : array, shape = (n_clusters, n_features)
@@ -72,12 +69,13 @@ class KMedoids(BaseEstimator, ClusterMixin, TransformerMixin):
 
     """
 
-    def __init__(self, n_clusters=8, metric="euclidean", max_iter=500, random_state=None, min_cluster_size=1):
+    def __init__(self, n_clusters=8, metric="euclidean", max_iter=500, min_cluster_size=1,
+                 method="alternate"):
         self.n_clusters = n_clusters
         self.metric = metric
         self.max_iter = max_iter
-        self.random_state = random_state
         self.min_cluster_size = min_cluster_size
+        self.method = method
 
     def _check_nonnegative_int(self, value, desc):
         """ Validates if value is a valid integer > 0 """
@@ -89,8 +87,10 @@ class KMedoids(BaseEstimator, ClusterMixin, TransformerMixin):
         # Check n_clusters and max_iter
         self._check_nonnegative_int(self.n_clusters, "n_clusters")
         self._check_nonnegative_int(self.max_iter, "max_iter")
+        if self.method not in ["alternate", "fasterpam"]:
+            raise ValueError("method should be 'alternate' or 'fasterpam'. %s was given" % self.method)
 
-    def fit(self, X, old_centers):
+    def fit(self, X, old_centers=None):
         """
         Fit K-Medoids to the provided data.
 
@@ -100,30 +100,67 @@ class KMedoids(BaseEstimator, ClusterMixin, TransformerMixin):
                 or (n_samples, n_samples) if metric == 'precomputed'
             Dataset to cluster.
 
+        old_centers : list of indices, optional
+            Medoids to start from (see _init_centers), the BUILD step of PAM if not given
+
         Returns
         -------
         self
         """
-        random_state_ = check_random_state(self.random_state)
+        X = check_array(X, accept_sparse=["csr", "csc"])
+        D = pairwise_distances(X, metric=self.metric)
+        self.fit_distances(D, old_centers)
+        self._set_cluster_centers(X)
+
+        # Return self to enable method chaining
+        return self
 
+    def _set_cluster_centers(self, X):
+        if self.metric == "precomputed":
+            self.cluster_centers_ = None
+        else:
+            self.cluster_centers_ = X[self.medoid_indices_]
+
+    def fit_distances(self, D, old_centers=None):
+        """ fit on a validated (n_samples, n_samples) distance matrix, doesn't set cluster_centers_ """
         self._check_init_args()
-        X = check_array(X, accept_sparse=["csr", "csc"])
-        if self.n_clusters > X.shape[0]:
+        if self.n_clusters > D.shape[0]:
             raise ValueError(
                 "The number of medoids (%d) must be less "
                 "than the number of samples %d."
-                % (self.n_clusters, X.shape[0])
+                % (self.n_clusters, D.shape[0])
             )
 
-        D = pairwise_distances(X, metric=self.metric)
-        medoid_idxs = self._init_centers(D, self.n_clusters, old_centers=old_centers)
-        labels = None
+        medoid_idxs = np.array(self._init_centers(D, self.n_clusters, old_centers=old_centers))
+        if self.method == "fasterpam":
+            medoid_idxs = self._swap(D, medoid_idxs)
+            labels = self._steal(D, medoid_idxs, np.argmin(D[medoid_idxs, :], axis=0))
+            self._update_medoid_idxs_in_place(D, labels, medoid_idxs)
+        else:
+            labels = self._alternate(D, medoid_idxs)
 
+        # Expose labels_ which are the assignments of
+        # the training data to clusters
+        self.labels_ = labels
+        self.medoid_indices_ = medoid_idxs
+        self.score_ = self._compute_score(D)
+
+        # Return self to enable method chaining
+        return self
+
+    def _alternate(self, D, medoid_idxs):
+        """
+        Assign points to the nearest medoid and move the medoids to the center of their clusters until nothing changes
+        Returns the labels, medoid_idxs are updated in place
+        """
+        labels = None
+        seen = set()
         # Continue the algorithm as long as
         # the medoids keep changing and the maximum number
         # of iterations is not exceeded
         for self.n_iter_ in range(0, self.max_iter):
             old_medoid_idxs = np.copy(medoid_idxs)
+            seen.add(tuple(old_medoid_idxs))
             labels = np.argmin(D[medoid_idxs, :], axis=0)
             # Change labels to avoid small clusters
             labels = self._steal(D, medoid_idxs, labels)
@@ -132,6 +169,9 @@ class KMedoids(BaseEstimator, ClusterMixin, TransformerMixin):
             self._update_medoid_idxs_in_place(D, labels, medoid_idxs)
             if np.all(old_medoid_idxs == medoid_idxs):
                 break
+            # Stealing can make the medoids cycle, stop at the first repetition
+            if tuple(medoid_idxs) in seen:
+                break
             elif self.n_iter_ == self.max_iter - 1:
                 warnings.warn(
                     "Maximum number of iteration reached before "
@@ -139,30 +179,19 @@ class KMedoids(BaseEstimator, ClusterMixin, TransformerMixin):
                     "improve the fit.",
                     ConvergenceWarning,
                 )
-
-        # Set the resulting instance variables.
-        if self.metric == "precomputed":
-            self.cluster_centers_ = None
-        else:
-            self.cluster_centers_ = X[medoid_idxs]
-
-        # Expose labels_ which are the assignments of
-        # the training data to clusters
-        self.labels_ = labels
-        self.medoid_indices_ = medoid_idxs
-        self.score_ = self._compute_score(D)
-
-        # Return self to enable method chaining
-        return self
+        return labels
 
     def _update_medoid_idxs_in_place(self, D, labels, medoid_idxs):
-        """ In-place update of the medoid indices """
+        """
+        In-place update of the medoid indices
+        The clusters are contiguous segments of the points sorted by label, so no cluster is searched for its points
+        """
+        order = np.argsort(labels, kind="stable")
+        bounds = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=self.n_clusters))])
 
         # Update the medoids for each cluster
         for k in range(self.n_clusters):
-            # Extract the distance matrix between the data points
-            # inside the cluster k
-            cluster_k_idxs = np.where(labels == k)[0]
+            cluster_k_idxs = order[bounds[k]:bounds[k + 1]]
 
             if len(cluster_k_idxs) == 0:
                 warnings.warn(
@@ -173,19 +202,14 @@ class KMedoids(BaseEstimator, ClusterMixin, TransformerMixin):
                 )
                 continue
 
-            in_cluster_distances = D[np.ix_(cluster_k_idxs, cluster_k_idxs)]
-
             # Calculate all costs from each point to all others in the cluster
-            in_cluster_all_costs = np.sum(in_cluster_distances, axis=1)
+            in_cluster_all_costs = np.sum(D[np.ix_(cluster_k_idxs, cluster_k_idxs)], axis=1)
 
             min_cost_idx = np.argmin(in_cluster_all_costs)
-            min_cost = in_cluster_all_costs[min_cost_idx]
-            curr_cost = in_cluster_all_costs[
-                np.argmax(cluster_k_idxs == medoid_idxs[k])
-            ]
+            curr_cost = in_cluster_all_costs[np.argmax(cluster_k_idxs == medoid_idxs[k])]
 
             # Adopt a new medoid if its distance is smaller then the current
-            if min_cost < curr_cost:
+            if in_cluster_all_costs[min_cost_idx] < curr_cost:
                 medoid_idxs[k] = cluster_k_idxs[min_cost_idx]
 
     def _steal(self, D, medoid_idxs, labels):
@@ -194,28 +218,88 @@ class KMedoids(BaseEstimator, ClusterMixin, TransformerMixin):
         Don't steal from a cluster if it has only one data point left
         and not from a cluster with smaller index if it hasn't enough data points
         """
-        cluster_idxs = [np.where(labels == k)[0] for k in range(self.n_clusters)]
-        cluster_sizes = [len(cidxs) for cidxs in cluster_idxs]
+        cluster_sizes = np.bincount(labels, minlength=self.n_clusters)
 
         # All clusters have correct size
-        if np.all(np.array(cluster_sizes) >= self.min_cluster_size):
+        if np.all(cluster_sizes >= self.min_cluster_size):
             return labels
 
+        labels = labels.copy()
+        cluster_range = np.arange(self.n_clusters)
         for k in range(self.n_clusters):
             while cluster_sizes[k] < self.min_cluster_size:
                 # Best steals from all possible other clusters
-                steals = [(j, np.argmin(D[cluster_idxs[j], medoid_idxs[k]]), np.min(D[cluster_idxs[j], medoid_idxs[k]]))
-                          for j in range(self.n_clusters) if j != k and cluster_sizes[j] > 0 and
-                          (cluster_sizes[j] > self.min_cluster_size or j > k)]
+                allowed = (cluster_range != k) & (cluster_sizes > 0) & \
+                          ((cluster_sizes > self.min_cluster_size) | (cluster_range > k))
                 # Steal the one with the smallest distance to medoid of cluster k
-                j, oth, _ = min(steals, key=lambda x: x[2])
-                labels[cluster_idxs[j][oth]] = k
+                candidates = np.where(allowed[labels], D[:, medoid_idxs[k]], np.inf)
+                oth = np.argmin(candidates)
+                if not np.isfinite(candidates[oth]):
+                    raise ValueError("No cluster to steal from")
+                cluster_sizes[labels[oth]] -= 1
                 cluster_sizes[k] += 1
-                cluster_sizes[j] -= 1
-                cluster_idxs[k] = np.where(labels == k)[0]
-                cluster_idxs[j] = np.where(labels == j)[0]
+                labels[oth] = k
         return labels
 
+    def _swap(self, D, medoid_idxs):
+        """
+        FasterPAM (Schubert and Rousseeuw, 2019): eagerly swap a medoid with a non-medoid if it lowers the total distance
+        of the points to their nearest medoid. With the distance to the nearest and second nearest medoid cached,
+        the change for swapping a candidate with every medoid at once is O(n).
+        Stops after a whole pass over the points without a swap
+        """
+        n = D.shape[0]
+        medoid_idxs = np.array(medoid_idxs)
+        nearest, d1, d2 = self._nearest_medoids(D, medoid_idxs)
+        # Removing a medoid moves its points to their second nearest medoid
+        removal = np.bincount(nearest, weights=d2 - d1, minlength=self.n_clusters)
+        last_swap = 0
+        self.n_swaps_ = 0
+        for self.n_iter_ in range(0, self.max_iter):
+            for c in range(n):
+                if c == last_swap and self.n_iter_ > 0:
+                    return medoid_idxs
+                if np.any(medoid_idxs == c):
+                    continue
+                d_c = D[:, c]
+                if self.n_clusters == 1:
+                    # All points move to c
+                    delta = np.array([np.sum(d_c - d1)])
+                else:
+                    # Or to c if it is nearer
+                    closer = d_c < d1
+                    second = ~closer & (d_c < d2)
+                    delta = removal + np.sum((d_c - d1)[closer])
+                    delta += np.bincount(nearest[closer], weights=(d1 - d2)[closer], minlength=self.n_clusters)
+                    delta += np.bincount(nearest[second], weights=(d_c - d2)[second], minlength=self.n_clusters)
+                best = np.argmin(delta)
+                if delta[best] < -1e-12:
+                    medoid_idxs[best] = c
+                    nearest, d1, d2 = self._nearest_medoids(D, medoid_idxs)
+                    removal = np.bincount(nearest, weights=d2 - d1, minlength=self.n_clusters)
+                    last_swap = c
+                    self.n_swaps_ += 1
+            if self.n_swaps_ == 0:
+                return medoid_idxs
+        warnings.warn(
+            "Maximum number of iteration reached before "
+            "convergence. Consider increasing max_iter to "
+            "improve the fit.",
+            ConvergenceWarning,
+        )
+        return medoid_idxs
+
+    def _nearest_medoids(self, D, medoid_idxs):
+        """ Index of the nearest medoid and distances to the nearest and second nearest medoid of every point """
+        to_medoids = D[medoid_idxs, :]
+        if len(medoid_idxs) == 1:
+            return np.zeros(D.shape[0], dtype=int), to_medoids[0], np.full(D.shape[0], np.inf)
+        nearest_two = np.argpartition(to_medoids, 1, axis=0)[:2]
+        first = np.take_along_axis(to_medoids, nearest_two, axis=0)
+        swap = first[0] > first[1]
+        nearest = np.where(swap, nearest_two[1], nearest_two[0])
+        return nearest, np.min(first, axis=0), np.max(first, axis=0)
+
     def _compute_score(self, distances):
         """
         Computes the score of a k-clustering with the Sum of the Squared distances to the cluster centers xi
@@ -225,11 +309,8 @@ class KMedoids(BaseEstimator, ClusterMixin, TransformerMixin):
         distance matrix for the n points
         labels_ and medoid_indices_ have to be set
         """
-        score = 0
-        for i in range(self.n_clusters):
-            in_cluster_distances = distances[self.labels_ == i, self.medoid_indices_[i]]
-            score += np.sum(in_cluster_distances**2)
-        return score
+        to_medoid = distances[np.arange(len(self.labels_)), np.asarray(self.medoid_indices_)[self.labels_]]
+        return np.sum(to_medoid ** 2)
 
     def _init_centers(self, D, n_clusters, old_centers):
         """
@@ -239,21 +320,102 @@ class KMedoids(BaseEstimator, ClusterMixin, TransformerMixin):
         add centers with biggest squared distance to other clusters centers.
         If more than n_clusters are given
         delete centers from smallest clusters if more than n_clusters.
+        Without old centers use the BUILD step of PAM
         """
         if old_centers is None or len(old_centers) == 0:
-            raise ValueError("Old centers should be a nonempty list")
+            return self._build(D, n_clusters)
 
         if len(old_centers) == n_clusters:
-            return old_centers
+            return list(old_centers)
         elif len(old_centers) > n_clusters:
-            return old_centers[:n_clusters]
+            return list(old_centers[:n_clusters])
         else:
-            centers = old_centers.copy()
+            centers = list(old_centers)
+            is_center = np.zeros(D.shape[1], dtype=bool)
+            is_center[centers] = True
             while len(centers) < n_clusters:
                 # Biggest MSD
-                new = np.argmax(np.sum(D[np.ix_([i for i in range(D.shape[1]) if i not in centers], centers)], axis=1)**2)
-                # Include offset
-                centers += [new + len([c for c in centers if c < new])]
+                msd = np.where(is_center, -np.inf, np.sum(D[:, centers], axis=1) ** 2)
+                new = int(np.argmax(msd))
+                centers += [new]
+                is_center[new] = True
             return centers
 
+    def _build(self, D, n_clusters):
+        """ Greedily add the medoid that lowers the total distance the most, starting with the most central point """
+        centers = [int(np.argmin(np.sum(D, axis=1)))]
+        d1 = D[:, centers[0]].copy()
+        while len(centers) < n_clusters:
+            gains = np.sum(np.maximum(d1[:, None] - D, 0), axis=0)
+            gains[centers] = -np.inf
+            new = int(np.argmax(gains))
+            centers += [new]
+            d1 = np.minimum(d1, D[:, new])
+        return centers
+
+
+def fit_multi_k(X, ks, old_centers=None, metric="euclidean", max_iter=500, min_cluster_size=1, method="alternate",
+                parallel_from=1000):
+    """
+    Fit KMedoids for every number of clusters in ks, returns {k: fitted KMedoids}
 
+    X is validated and the distances are computed only once.
+    The k nearest to the number of old_centers starts from old_centers, all other ks start from its medoids
+    with medoids added or removed (see KMedoids._init_centers) and refine them.
+    With at least parallel_from samples the other ks are fitted in threads.
+    """
+    X = check_array(X, accept_sparse=["csr", "csc"])
+    D = pairwise_distances(X, metric=metric)
+    kmedoids = {k: KMedoids(n_clusters=k, metric=metric, max_iter=max_iter, min_cluster_size=min_cluster_size,
+                            method=method) for k in ks}
+
+    start = min(ks, key=lambda k: abs(k - len(old_centers if old_centers is not None else [])))
+    kmedoids[start].fit_distances(D, old_centers)
+    start_centers = list(kmedoids[start].medoid_indices_)
+
+    others = [k for k in ks if k != start]
+    if D.shape[0] >= parallel_from and len(others) > 1:
+        with ThreadPoolExecutor(max_workers=len(others)) as pool:
+            list(pool.map(lambda k: kmedoids[k].fit_distances(D, start_centers), others))
+    else:
+        for k in others:
+            kmedoids[k].fit_distances(D, start_centers)
+
+    for k in ks:
+        kmedoids[k]._set_cluster_centers(X)
+    return kmedoids
+
+
+if __name__ == '__main__':
+    import time
+
+    # Blobs of points, clustered warm started from some of their centers like Population.cluster does.
+    # Big min_cluster_size and few old centers, so stealing and adding centers is needed
+    rng = np.random.RandomState(0)
+    n_blobs, n_clusters = 8, 20
+    for n in [100, 500, 1000, 2000, 5000]:
+        X = rng.normal(size=(n, 10)) + 4 * rng.randint(0, n_blobs, size=(n, 1))
+        D = pairwise_distances(X)
+        old_centers = list(rng.choice(n, size=n_clusters // 4, replace=False))
+        for method in ["alternate", "fasterpam"]:
+            start = time.time()
+            kmedoids = KMedoids(n_clusters=n_clusters, metric="precomputed", min_cluster_size=n // (2 * n_clusters),
+                                method=method).fit(D, old_centers=old_centers)
+            print("n = %4d | %-9s | %8.3fs | score %.4e | iterations %d" %
+                  (n, method, time.time() - start, kmedoids.score_, kmedoids.n_iter_ + 1))
+
+    # All ks near the number of old centers like Population.cluster, separately and with fit_multi_k
+    for n in [1000, 5000]:
+        X = rng.normal(size=(n, 10)) + 4 * rng.randint(0, n_blobs, size=(n, 1))
+        D = pairwise_distances(X)
+        old_centers = list(rng.choice(n, size=n_blobs, replace=False))
+        ks = list(range(n_blobs - 2, n_blobs + 3))
+        start = time.time()
+        separate = {k: KMedoids(n_clusters=k, metric="precomputed", min_cluster_size=5).fit(D, old_centers=old_centers)
+                    for k in ks}
+        separate_time = time.time() - start
+        start = time.time()
+        multi = fit_multi_k(D, ks, old_centers=old_centers, metric="precomputed", min_cluster_size=5)
+        print("n = %4d | k = %s | separate %7.3fs | multi-k %7.3fs | scores separate %s multi-k %s" %
+              (n, ks, separate_time, time.time() - start, ["%.3e" % separate[k].score_ for k in ks],
+               ["%.3e" % multi[k].score_ for k in ks]))
@@ -0,0 +1,251 @@
+import os
+import json
+import time
+import random
+import shutil
+import logging
+import platform
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+
+import torch
+import torchvision
+
+from KMedoids import KMedoids
+from population import Population
+from crossover import crossover
+from selection import cut_off_selection, tournament_selection, fitness_proportionate_selection,\
+    fitness_proportionate_tournament_selection, linear_ranking_selection, stochastic_universal_sampling
+from distance import DistanceCache, pairwise_dissimilarity
+from checkpoint import ShardedCheckpoint
+from dataset import DatasetCache, CachedLoader
+from net import build_net_from_genome, train_on_data, save_trained
+
+
+class Benchmark:
+    """
+    Times the hot paths of the evolution on synthetic populations, on the cpu and without downloading anything
+    -----
+    sizes      - population sizes to benchmark
+    mutations  - how often every genome of a population is mutated (mutate_random), i.e. how complex genomes are
+    repeats    - how often every benchmark is timed, results keep the min, median and mean
+    n_nets     - how many genomes of a population are built into nets (building, forward, training, checkpoints)
+    batch_size - of the random inputs for Net.forward and of the fake dataset
+    seed       - everything (genomes, inputs, dataset) is generated from it, so runs on two commits compare
+
+    run() returns and write() saves a json with the environment (commit, versions, threads) and one result per
+    benchmark and size, compare() lists the benchmarks that got slower than in an earlier result file
+    """
+
+    def __init__(self, sizes=(20, 100), mutations=10, repeats=5, n_nets=10, batch_size=100, input_size=(1, 28, 28),
+                 output_size=10, seed=0, directory=None):
+        self.sizes = sizes
+        self.mutations = mutations
+        self.repeats = repeats
+        self.n_nets = n_nets
+        self.batch_size = batch_size
+        self.input_size = list(input_size)
+        self.output_size = output_size
+        self.seed = seed
+        self.directory = directory
+        self.results = []
+
+    def seed_all(self, offset=0):
+        random.seed(self.seed + offset)
+        np.random.seed(self.seed + offset)
+        torch.manual_seed(self.seed + offset)
+
+    def synthetic_population(self, n, root):
+        """ A Population of n genomes, each mutated <mutations> times and trained a random number of epochs """
+        self.seed_all(n)
+        population = Population(n, self.input_size, self.output_size, evaluate=None, parent_selection=None,
+                                train=None, name='benchmark', async_checkpoints=False, profile=False)
+        population.checkpoints = ShardedCheckpoint(root=root)
+        population.this_gen_random_state = (random.getstate(), np.random.get_state(), torch.get_rng_state())
+        genomes = [g for genomes in population.species.values() for g in genomes]
+        for _ in range(self.mutations):
+            this_gen_mutations = dict()
+            for g in genomes:
+                g.mutate_random(this_gen_mutations)
+                g.trained = random.randrange(10)
+        return population, genomes
+
+    def fake_loader(self, n_batches):
+        """ A CachedLoader over torchvision's FakeData (random images, decoded once) """
+        data = torchvision.datasets.FakeData(size=n_batches * self.batch_size, image_size=self.input_size,
+                                             num_classes=self.output_size,
+                                             transform=torchvision.transforms.ToTensor(), random_offset=self.seed)
+        cache = DatasetCache(data, torch_device='cpu')
+        return CachedLoader(cache, range(len(cache)), batch_size=self.batch_size)
+
+    def time(self, name, n, run, setup=None, **info):
+        """
+        Time run(setup()) <repeats> times, setup is not timed
+        Every repeat starts from the same random state
+        """
+        seconds = []
+        for repeat in range(self.repeats):
+            self.seed_all(n)
+            args = setup() if setup is not None else None
+            start = time.perf_counter()
+            run(args)
+            seconds += [time.perf_counter() - start]
+        result = {'name': name, 'n': n, 'mutations': self.mutations, 'repeats': self.repeats,
+                  'min': min(seconds), 'median': float(np.median(seconds)), 'mean': float(np.mean(seconds)),
+                  **info}
+        logging.info('%-24s n = %4d | min %9.4fs | median %9.4fs' % (name, n, result['min'], result['median']))
+        self.results += [result]
+        return result
+
+    def run(self):
+        """ Run all benchmarks for all population sizes """
+        self.results = []
+        root = self.directory or tempfile.mkdtemp(prefix='convNEAT_benchmark_')
+        try:
+            for n in self.sizes:
+                self.run_population(n, os.path.join(root, str(n)))
+        finally:
+            if self.directory is None:
+                shutil.rmtree(root, ignore_errors=True)
+        return {'environment': environment(), 'config': self.config(), 'results': self.results}
+
+    def config(self):
+        return {'sizes': list(self.sizes), 'mutations': self.mutations, 'repeats': self.repeats,
+                'n_nets': self.n_nets, 'batch_size': self.batch_size, 'input_size': self.input_size,
+                'output_size': self.output_size, 'seed': self.seed}
+
+    def run_population(self, n, root):
+        population, genomes = self.synthetic_population(n, root)
+        genes = sum(len(g.genes) for g in genomes) / n
+        self.time('population', n, lambda _: self.synthetic_population(n, root), genes=genes)
+
+        # Distances and clustering
+        rows = min(n, 30)
+        self.time('dissimilarity', n, lambda _: [[genomes[i].dissimilarity(genomes[j]) for j in range(rows)]
+                                                 for i in range(rows)], pairs=rows ** 2)
+        self.time('pairwise_dissimilarity', n, lambda _: pairwise_dissimilarity(genomes), pairs=n ** 2)
+        distances = pairwise_dissimilarity(genomes)
+        k = max(1, min(population.max_species, n // population.min_species_size))
+        old_centers = list(np.random.RandomState(self.seed).choice(n, size=max(1, k // 2), replace=False))
+        for method in ['alternate', 'fasterpam']:
+            self.time('kmedoids_' + method, n,
+                      lambda _: KMedoids(n_clusters=k, metric='precomputed', min_cluster_size=population.min_species_size,
+                                         method=method).fit(distances, old_centers=old_centers), k=k)
+
+        def fresh_cache():
+            population.distance_cache = DistanceCache()
+        self.time('cluster', n, lambda _: population.cluster(), setup=fresh_cache)
+
+        # Breeding
+        evaluated_genomes = sorted([(g, random.random()) for g in genomes], key=lambda x: x[1], reverse=True)
+        for selection in [cut_off_selection, tournament_selection, fitness_proportionate_selection,
+                          fitness_proportionate_tournament_selection, linear_ranking_selection,
+                          stochastic_universal_sampling]:
+            self.time(selection.__name__, n, lambda _: selection(evaluated_genomes, k=n))
+
+        def pairs():
+            return [random.sample(genomes, k=2) for _ in range(n)]
+        self.time('crossover', n, lambda couples: [crossover(g1, g2) for g1, g2 in couples], setup=pairs)
+
+        def copies():
+            return [g.copy() for g in genomes]
+        self.time('mutate_random', n, lambda children: [g.mutate_random(dict()) for g in children], setup=copies)
+        self.time('set_sizes', n, lambda _: [g.set_sizes(self.input_size) for g in genomes])
+
+        # Nets
+        n_nets = min(n, self.n_nets)
+        self.time('build_net_from_genome', n,
+                  lambda _: [build_net_from_genome(g, self.input_size, self.output_size) for g in genomes[:n_nets]],
+                  nets=n_nets)
+        built = [build_net_from_genome(g, self.input_size, self.output_size) for g in genomes[:n_nets]]
+        inputs = torch.randn(self.batch_size, *self.input_size)
+
+        def forward(_):
+            with torch.no_grad():
+                for net, _, _ in built:
+                    net(inputs)
+        self.time('forward', n, forward, nets=n_nets, samples=n_nets * self.batch_size)
+        loader = self.fake_loader(n_batches=5)
+
+        def train(_):
+            for g, (net, optimizer, criterion) in zip(genomes, built):
+                train_on_data(g, net, optimizer, criterion, epochs=1, torch_device='cpu', data_loader_train=loader,
+                              save_net_param=False, save_gene_param=False)
+        self.time('train_on_data', n, train, nets=n_nets, samples=n_nets * len(loader.indices))
+
+        # Checkpoints, the built genomes get parameters so they are written as shards
+        for g, (net, optimizer, _) in zip(genomes, built):
+            save_trained(g, net, optimizer)
+        checkpoints = population.checkpoints
+
+        def fresh_checkpoints():
+            # Not incremental, every shard is written
+            population.checkpoints = ShardedCheckpoint(root=checkpoints.root)
+        size = {}
+
+        def save(_):
+            size['bytes'] = population.checkpoints.save(population)
+        self.time('checkpoint_save', n, save, setup=fresh_checkpoints)
+        self.results[-1]['bytes'] = size['bytes']
+        self.time('checkpoint_load', n, lambda _: population.checkpoints.load(
+            population, population.checkpoint_name, population.generation), setup=fresh_checkpoints)
+
+    def write(self, output, report):
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=1)
+
+
+def environment():
+    """ What the timings depend on besides the code """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'commit': commit, 'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': platform.python_version(),
+            'platform': platform.platform(), 'processor': platform.processor(), 'numpy': np.__version__,
+            'torch': torch.__version__, 'threads': torch.get_num_threads()}
+
+
+def compare(old, new, tolerance=0.1):
+    """
+    Benchmarks (name and population size) whose median in the report new is more than <tolerance> slower
+    than in the report old, as [name, n, old median, new median]
+    """
+    old_medians = {(r['name'], r['n']): r['median'] for r in old['results']}
+    return [[r['name'], r['n'], old_medians[(r['name'], r['n'])], r['median']] for r in new['results']
+            if (r['name'], r['n']) in old_medians and r['median'] > (1 + tolerance) * old_medians[(r['name'], r['n'])]]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the evolution hot paths on synthetic populations (cpu only)')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[20, 100], help='population sizes')
+    parser.add_argument('--mutations', type=int, default=10, help='mutations of every genome')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--nets', type=int, default=10, help='genomes built into nets per population')
+    parser.add_argument('--threads', type=int, default=1, help='torch threads, fixed for comparable timings')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--compare', default=None, help='an earlier output to compare to')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative slowdown that counts as regression')
+    args = parser.parse_args()
+
+    logging.basicConfig(level='INFO')
+    torch.set_num_threads(args.threads)
+    benchmark = Benchmark(sizes=args.sizes, mutations=args.mutations, repeats=args.repeats, n_nets=args.nets,
+                          seed=args.seed)
+    report = benchmark.run()
+    benchmark.write(args.output, report)
+    print('Results written to %s' % args.output)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            old = json.load(f)
+        regressions = compare(old, report, tolerance=args.tolerance)
+        for name, n, old_median, new_median in regressions:
+            print('%-24s n = %4d | %9.4fs -> %9.4fs (%+.0f%%)' %
+                  (name, n, old_median, new_median, 100 * (new_median / old_median - 1)))
+        if not regressions:
+            print('No regressions compared to %s (commit %s)' % (args.compare, old['environment']['commit']))
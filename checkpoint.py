@@ -0,0 +1,256 @@
+import os
+import time
+import queue
+import pickle
+import logging
+import threading
+import uuid
+import weakref
+import collections
+
+import torch
+
+
+class ShardedCheckpoint:
+    """
+    Checkpoints as a small index per generation and one tensor shard per genome
+    -----
+    <root>/<name>/<generation>.idx  - pickled metadata and genome structures (Genome.save without parameters)
+    <root>/<name>/shards/<id>.pt    - torch.save of a genome's net parameters and optimizer state
+
+    Saving is incremental: a genome whose parameters are still the ones written before (elites between two
+    generations, genomes loaded without parameters) refers to its old shard.
+    Loading is lazy: without load_params only the index is read, load_parameters reads a genome's shard later.
+    After every write, shards no index refers to anymore (discarded genomes, overwritten indexes) are deleted.
+    keep - how many of the newest generations are kept, older indexes are deleted (None keeps all)
+    """
+
+    def __init__(self, root='checkpoints', keep=None):
+        if keep is not None and keep < 1:
+            raise ValueError('keep should be at least 1 or None, %d was given' % keep)
+        self.root = root
+        self.keep = keep
+        # Genome -> [net parameters, optimizer parameters, shard file] when last written/loaded
+        self.written = weakref.WeakKeyDictionary()
+        # Shards referred to by every index written or read (path -> shard names)
+        # and how often by snapshots that aren't written yet
+        self.index_shards = dict()
+        self.pending = collections.Counter()
+        self.lock = threading.Lock()
+
+    def index_path(self, checkpoint_name, generation):
+        return os.path.join(self.root, checkpoint_name, "%02d.idx" % generation)
+
+    def exists(self, checkpoint_name, generation):
+        return os.path.exists(self.index_path(checkpoint_name, generation))
+
+    def save(self, population):
+        """ Write the index of the current generation and the shards of all changed genomes """
+        return self.write(self.snapshot(population))
+
+    def snapshot(self, population):
+        """
+        Everything save writes, taken now so it can be written later while the population changes
+        The index is pickled right away (it is small), shards hold copies of the parameters (see owned_copy),
+        training updates the tensors of the genomes in place while they are written
+        """
+        _dir = os.path.join(self.root, population.checkpoint_name)
+        shards = []
+        index = [population.n, population.id_generator, population.species_id_generator, population.generation,
+                 population.input_size, population.output_size, population.checkpoint_name, population.top_acc,
+                 population.history, population.this_gen_random_state,
+                 self.snapshot_genome(population.best_genome, _dir, shards),
+                 {species: [self.snapshot_genome(genome, _dir, shards) for genome in genomes]
+                  for species, genomes in population.species.items()}]
+        referenced = referenced_shards(index)
+        with self.lock:
+            self.pending.update(referenced)
+        return (population.generation, os.path.join(_dir, 'shards'),
+                self.index_path(population.checkpoint_name, population.generation), pickle.dumps(index), shards,
+                referenced)
+
+    def snapshot_genome(self, genome, _dir, shards):
+        """ The index entry of a genome, adds a new shard to shards if its parameters changed """
+        net_parameters = genome.net_parameters
+        optimizer_parameters = getattr(genome.optimizer, 'parameters', None)
+        written = self.written.get(genome)
+        if written is not None and written[0] is net_parameters and written[1] is optimizer_parameters:
+            shard = written[2]
+        elif net_parameters is None and optimizer_parameters is None:
+            shard = None
+        else:
+            shard = os.path.join(_dir, 'shards', uuid.uuid4().hex + '.pt')
+            shards += [(shard, {'net': owned_copy(net_parameters), 'optimizer': owned_copy(optimizer_parameters)})]
+        self.written[genome] = [net_parameters, optimizer_parameters, shard]
+        return (genome.__class__, genome.save(parameters=False), shard and os.path.basename(shard),
+                {'memory': genome.memory, 'history': genome.history})
+
+    def write(self, snapshot):
+        """
+        Write a snapshot, shards before the index that refers to them, then delete what isn't needed anymore
+        Returns the bytes written
+        """
+        _, shard_dir, index_path, index, shards, referenced = snapshot
+        if not os.path.exists(shard_dir):
+            os.makedirs(shard_dir)
+        for path, parameters in shards:
+            atomic_write(path, lambda f: torch.save(parameters, f))
+        atomic_write(index_path, lambda f: f.write(index))
+        written = len(index) + sum(os.path.getsize(path) for path, _ in shards)
+        with self.lock:
+            self.index_shards[index_path] = referenced
+            self.pending.subtract(referenced)
+        self.prune(os.path.dirname(index_path), shard_dir)
+        return written
+
+    def prune(self, _dir, shard_dir):
+        """ Delete the indexes older than the <keep> newest and the shards no index or pending snapshot needs """
+        indexes = sorted([f for f in os.listdir(_dir) if f.endswith('.idx')], key=lambda f: int(f.split('.')[0]))
+        if self.keep is not None:
+            for f in indexes[:-self.keep]:
+                os.remove(os.path.join(_dir, f))
+                self.index_shards.pop(os.path.join(_dir, f), None)
+            indexes = indexes[-self.keep:]
+        needed = set()
+        for f in indexes:
+            path = os.path.join(_dir, f)
+            if path not in self.index_shards:
+                # Written by an earlier run
+                with open(path, 'rb') as c:
+                    self.index_shards[path] = referenced_shards(pickle.load(c))
+            needed |= self.index_shards[path]
+        with self.lock:
+            needed |= {shard for shard, count in self.pending.items() if count > 0}
+        removed = [f for f in os.listdir(shard_dir) if f.endswith('.pt') and f not in needed]
+        for f in removed:
+            os.remove(os.path.join(shard_dir, f))
+        if len(removed) > 0:
+            logging.info('Deleted %d shards no checkpoint refers to' % len(removed))
+
+    def load(self, population, checkpoint_name, generation, load_params=True):
+        with open(self.index_path(checkpoint_name, generation), "rb") as c:
+            [population.n, population.id_generator, population.species_id_generator, population.generation,
+             population.input_size, population.output_size, population.checkpoint_name, population.top_acc,
+             population.history, saved_random_state, saved_best_genome, saved_genomes] = pickle.load(c)
+        _dir = os.path.join(self.root, checkpoint_name)
+        population.best_genome = self.load_genome(population, saved_best_genome, _dir, load_params)
+        population.species = {species: [self.load_genome(population, genome, _dir, load_params)
+                                        for genome in genomes]
+                              for species, genomes in saved_genomes.items()}
+        return saved_random_state
+
+    def load_genome(self, population, saved, _dir, load_params):
+        genome_class, saved_genome, shard, extras = saved
+        genome = genome_class(population).load(saved_genome)
+        genome.memory, genome.history = extras['memory'], extras['history']
+        self.written[genome] = [None, None, shard and os.path.join(_dir, 'shards', shard)]
+        if load_params:
+            self.load_parameters(genome)
+        return genome
+
+    def load_parameters(self, genome):
+        """ Read the net parameters and optimizer state of a genome loaded from a checkpoint """
+        shard = self.written[genome][2]
+        if shard is None:
+            return genome
+        parameters = torch.load(shard)
+        genome.net_parameters = parameters['net']
+        if hasattr(genome.optimizer, 'parameters'):
+            genome.optimizer.parameters = parameters['optimizer']
+        self.written[genome] = [genome.net_parameters, getattr(genome.optimizer, 'parameters', None), shard]
+        return genome
+
+
+class CheckpointWriter:
+    """
+    Writes the checkpoints of a ShardedCheckpoint on a background thread
+    -----
+    save only takes a snapshot, the serialization and writing happens in the background.
+    At most max_pending snapshots wait to be written, save blocks while the queue is full.
+    flush waits until everything is written, call it before the process ends.
+    With background=False everything is written in save.
+
+    stats - generation -> {'bytes', 'seconds' (writing), 'blocked' (time save waited for the queue)}
+    """
+
+    def __init__(self, checkpoints, max_pending=2, background=True):
+        if max_pending < 1:
+            raise ValueError('max_pending should be at least 1, %d was given' % max_pending)
+        self.checkpoints = checkpoints
+        self.background = background
+        self.stats = dict()
+        self.error = None
+        self.lock = threading.Lock()
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = None
+
+    def save(self, population):
+        self.raise_error()
+        snapshot = self.checkpoints.snapshot(population)
+        if not self.background:
+            self.write(snapshot)
+            return
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='checkpoint-writer', daemon=True)
+            self.thread.start()
+        start = time.time()
+        self.queue.put(snapshot)
+        self.record(snapshot[0], blocked=time.time() - start)
+
+    def flush(self):
+        """ Wait until all snapshots are written """
+        self.queue.join()
+        self.raise_error()
+
+    def run(self):
+        while True:
+            snapshot = self.queue.get()
+            try:
+                self.write(snapshot)
+            except Exception as e:
+                logging.error('Writing checkpoint %02d failed: %s' % (snapshot[0], e))
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def write(self, snapshot):
+        start = time.time()
+        written = self.checkpoints.write(snapshot)
+        seconds = time.time() - start
+        self.record(snapshot[0], bytes=written, seconds=seconds)
+        logging.info('Checkpoint %02d: wrote %.2f MB in %.3fs' % (snapshot[0], written / 2 ** 20, seconds))
+
+    def record(self, generation, **values):
+        with self.lock:
+            stats = self.stats.setdefault(generation, {'bytes': 0, 'seconds': 0., 'blocked': 0.})
+            for k, v in values.items():
+                stats[k] += v
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('Writing a checkpoint failed') from error
+
+
+def owned_copy(parameters):
+    """ A copy of (nested dicts and lists of) parameters that shares no tensors with them """
+    if isinstance(parameters, torch.Tensor):
+        return parameters.detach().clone()
+    if isinstance(parameters, dict):
+        return {k: owned_copy(v) for k, v in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return type(parameters)(owned_copy(v) for v in parameters)
+    return parameters
+
+
+def referenced_shards(index):
+    """ The names of the shards an index (see ShardedCheckpoint.snapshot) refers to """
+    entries = [index[10]] + [entry for entries in index[11].values() for entry in entries]
+    return {entry[2] for entry in entries if entry[2] is not None}
+
+
+def atomic_write(path, write):
+    """ Write to a temporary file first, so a crash never leaves a broken file """
+    with open(path + '.tmp', 'wb') as f:
+        write(f)
+    os.replace(path + '.tmp', path)
@@ -9,24 +9,37 @@ import torch
 from population import Population
 from selection import cut_off_selection, tournament_selection, fitness_proportionate_selection,\
     fitness_proportionate_tournament_selection, linear_ranking_selection, stochastic_universal_sampling
-from net import train_on_data, evaluate
+from net import train_on_data, train_together, evaluate
 from monitor import Monitor
 from exploration import show_genomes, from_human_readable
+from dataset import DatasetCache, CachedLoader
 
 
-def data_loader(data, batch_size=100, validation_size=0.15, **kwargs):
-    """ Build data loaders """
+def data_loader(data, batch_size=100, validation_size=0.15, torch_device='cpu', cache='device', **kwargs):
+    """
+    Build data loaders
+    cache - decode the data only once for all genomes, train and evaluation (device/mmap, see DatasetCache)
+            None loads every sample with a DataLoader
+    """
     val = int(validation_size * len(data))
-    data_train, data_val = torch.utils.data.random_split(data, [len(data) - val, val])
-    data_loader_train = torch.utils.data.DataLoader(data_train, batch_size=batch_size, shuffle=True)
-    data_loader_val = torch.utils.data.DataLoader(data_val, batch_size=batch_size, shuffle=True)
+    if cache is None:
+        data_train, data_val = torch.utils.data.random_split(data, [len(data) - val, val])
+        data_loader_train = torch.utils.data.DataLoader(data_train, batch_size=batch_size, shuffle=True)
+        data_loader_val = torch.utils.data.DataLoader(data_val, batch_size=batch_size, shuffle=True)
+    else:
+        # Same split as random_split
+        indices = torch.randperm(len(data))
+        cached = DatasetCache(data, torch_device=torch_device, mode=cache)
+        data_loader_train = CachedLoader(cached, indices[:len(data) - val], batch_size=batch_size)
+        data_loader_val = CachedLoader(cached, indices[len(data) - val:], batch_size=batch_size)
 
     return data_loader_train, data_loader_val
 
 
 class ConvNEAT:
 
-    def __init__(self, output_size, n=100, torch_device='cpu', name=None, monitoring=True, seed=None, max_gens=50):
+    def __init__(self, output_size, n=100, torch_device='cpu', name=None, monitoring=True, seed=None, max_gens=50,
+                 data_cache='device'):
         # manually seed all random number generators for reproducible results
         if seed is not None:
             random.seed(seed)
@@ -43,6 +56,7 @@ class ConvNEAT:
         self.monitoring = monitoring
         self.name = name
         self.max_gens = max_gens
+        self.data_cache = data_cache
 
     def evolve(self, p):
         for i in range(self.max_gens):
@@ -54,11 +68,13 @@ class ConvNEAT:
             if i == self.max_gens - 1:
                 logging.warning("Further training could potentially increase performance.\n"
                                 "Consider increasing max_generations for a better result.")
+        p.flush()
 
     def fit(self, data, load=None, **kwargs):
 
         input_size = list(data[0][0].shape)
-        data_loader_train, data_loader_val = data_loader(data, **kwargs)
+        data_loader_train, data_loader_val = data_loader(data, torch_device=self.torch_device,
+                                                         cache=self.data_cache, **kwargs)
 
         print('\n\nInitializing population\n')
         p = Population(input_size=input_size, output_size=self.output_size, name=self.name, n=self.n,
@@ -68,6 +84,11 @@ class ConvNEAT:
                            torch_device=self.torch_device,
                            data_loader_train=data_loader_train
                        ),
+                       train_group=functools.partial(
+                           train_together,
+                           torch_device=self.torch_device,
+                           data_loader_train=data_loader_train
+                       ),
                        evaluate=functools.partial(
                            evaluate,
                            torch_device=self.torch_device,
@@ -96,7 +117,8 @@ class ConvNEAT:
                 show_genomes(input_size=input_size)
                 return
             if loading == 'f':
-                data_loader_train, data_loader_val = data_loader(data, **kwargs)
+                data_loader_train, data_loader_val = data_loader(data, torch_device=self.torch_device,
+                                                                 cache=self.data_cache, **kwargs)
                 from_human_readable(input_size=input_size, output_size=self.output_size,
                                     evaluate=functools.partial(
                                         evaluate,
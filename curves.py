@@ -0,0 +1,85 @@
+import math
+import numpy as np
+
+
+class LearningCurves:
+    """
+    The section losses (see train_on_data) and accs of the last evaluated genomes of every species
+    Sections are counted over the lifetime of a genome (curve_offset), so the last loss of a curve is the one after
+    all training of the genome and genomes that continue training are extrapolated from where they are
+    Used to predict the acc of a genome during training and stop it if it won't reach the elites of its species
+    -----
+    max_curves   - how many curves are kept per species
+    min_curves   - how many curves a species needs before a genome is stopped
+    min_sections - how many sections a genome is trained at least
+    margin       - how far the prediction has to be below the elite cutoff
+    elitism_rate - which accs are elites (see Population)
+    """
+
+    def __init__(self, max_curves=20, min_curves=3, min_sections=5, margin=0.05, elitism_rate=0.1, neighbours=3):
+        self.curves = dict()
+        self.max_curves = max_curves
+        self.min_curves = min_curves
+        self.min_sections = min_sections
+        self.margin = margin
+        self.elitism_rate = elitism_rate
+        self.neighbours = neighbours
+
+    def snapshot(self):
+        """ A copy that doesn't change when curves are added """
+        curves = LearningCurves(self.max_curves, self.min_curves, self.min_sections, self.margin, self.elitism_rate,
+                                self.neighbours)
+        curves.curves = {species: list(references) for species, references in self.curves.items()}
+        return curves
+
+    def add(self, species, curve, acc, offset=0):
+        if len(curve) > 0:
+            self.curves[species] = (self.curves.get(species, []) + [(list(curve), acc, offset)])[-self.max_curves:]
+
+    def predict(self, species, losses, total, offset=0):
+        """
+        Extrapolate the losses (sections offset + 1, offset + 2, ...) to the end of training (section total)
+        and predict the acc as the mean acc of the genomes in the species that ended with the most similar loss.
+        None if there is not enough data
+        """
+        references = self.curves.get(species, [])
+        if len(references) < self.min_curves or len(losses) < self.min_sections:
+            return None
+        final = extrapolate_loss(losses, total, offset)
+        if final is None:
+            return None
+        final_losses = np.array([curve[-1] for curve, _, _ in references])
+        accs = np.array([acc for _, acc, _ in references])
+        valid = np.isfinite(final_losses) & (final_losses > 0)
+        if np.sum(valid) < self.min_curves:
+            return None
+        distance = np.abs(np.log(final_losses[valid]) - np.log(final))
+        return float(np.mean(accs[valid][np.argsort(distance)[:self.neighbours]]))
+
+    def cutoff(self, species):
+        """ The lowest acc of the elites among the curves of a species """
+        accs = sorted([acc for _, acc, _ in self.curves.get(species, [])], reverse=True)
+        return accs[max(1, math.ceil(self.elitism_rate * len(accs))) - 1] if len(accs) > 0 else None
+
+    def stop(self, species, end, losses, offset, sections):
+        """
+        The predicted acc if the genome should stop training (below the cutoff of its species), else None
+        end - the epoch of the genome's lifetime its budget ends with, sections - sections per epoch
+        """
+        predicted = self.predict(species, losses, end * sections, offset)
+        if predicted is not None and predicted < self.cutoff(species) - self.margin:
+            return predicted
+        return None
+
+
+def extrapolate_loss(losses, total, offset=0):
+    """
+    Fit a power law loss = a * t^b to the section losses (t = offset + 1, offset + 2, ...) and evaluate it
+    at section total
+    None if the losses can't be fitted (nan, not positive)
+    """
+    losses = np.array(losses, dtype=float)
+    if not np.all(np.isfinite(losses)) or np.any(losses <= 0):
+        return None
+    b, log_a = np.polyfit(np.log(np.arange(offset + 1, offset + len(losses) + 1)), np.log(losses), 1)
+    return float(np.exp(log_a + b * np.log(max(total, offset + len(losses)))))
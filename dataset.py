@@ -0,0 +1,99 @@
+import os
+import math
+import hashlib
+import logging
+import numpy as np
+
+import torch
+
+
+class DatasetCache:
+    """
+    A dataset decoded once (with all its transforms, e.g. normalization) into two contiguous tensors
+    -----
+    mode  - device: inputs and labels are resident on torch_device
+            mmap:   inputs are memory mapped from a .npy file in cache_dir and only the batches are moved,
+                    a existing file with the same name and shape is reused without decoding
+    name  - file name in cache_dir, identifies the dataset and its transforms,
+            by default the class and shape of the dataset and a hash of its transform
+    """
+
+    def __init__(self, data, torch_device='cpu', mode='device', cache_dir=os.path.join('data', 'cache'), name=None):
+        if mode not in ['device', 'mmap']:
+            raise ValueError('Cache mode %s not supported' % mode)
+        self.torch_device = torch_device
+        self.mode = mode
+
+        sample = data[0][0]
+        shape = [len(data)] + list(sample.shape)
+        if mode == 'mmap':
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            # The transforms are part of the name, so changing them decodes again
+            transform = hashlib.sha1(repr(getattr(data, 'transform', None)).encode()).hexdigest()[:10]
+            name = name or '%s_%s_%s' % (data.__class__.__name__, '_'.join(map(str, shape)), transform)
+            path = os.path.join(cache_dir, name)
+            if os.path.exists(path + '_inputs.npy') and os.path.exists(path + '_labels.npy') and \
+                    list(np.load(path + '_inputs.npy', mmap_mode='r').shape) == shape:
+                logging.info('Using cached dataset %s' % path)
+            else:
+                # Decoded into temporary files that are only renamed when complete, an interrupted decode isn't reused
+                inputs = np.lib.format.open_memmap(path + '_inputs.npy.tmp', mode='w+', dtype=np.float32,
+                                                   shape=tuple(shape))
+                labels = np.lib.format.open_memmap(path + '_labels.npy.tmp', mode='w+', dtype=np.int64,
+                                                   shape=(len(data),))
+                self.decode(data, torch.from_numpy(inputs), torch.from_numpy(labels))
+                inputs.flush()
+                labels.flush()
+                del inputs, labels
+                os.replace(path + '_labels.npy.tmp', path + '_labels.npy')
+                os.replace(path + '_inputs.npy.tmp', path + '_inputs.npy')
+            # Copy on write, so the arrays are writable for torch
+            self.inputs = torch.from_numpy(np.load(path + '_inputs.npy', mmap_mode='c'))
+            self.labels = torch.from_numpy(np.load(path + '_labels.npy')).to(torch_device)
+        else:
+            self.inputs = torch.empty(shape, dtype=torch.float32)
+            self.labels = torch.empty(len(data), dtype=torch.long)
+            self.decode(data, self.inputs, self.labels)
+            self.inputs = self.inputs.to(torch_device)
+            self.labels = self.labels.to(torch_device)
+
+    def __len__(self):
+        return len(self.labels)
+
+    @staticmethod
+    def decode(data, inputs, labels):
+        logging.info('Decoding dataset of %d samples' % len(data))
+        for i in range(len(data)):
+            x, y = data[i]
+            inputs[i] = torch.as_tensor(x)
+            labels[i] = int(y)
+
+    def batch(self, indices):
+        """ The inputs and labels at indices (a tensor on the labels device) on the device """
+        if self.mode == 'mmap':
+            return self.inputs[indices.cpu()].to(self.torch_device, non_blocking=True), self.labels[indices]
+        return self.inputs[indices], self.labels[indices]
+
+
+class CachedLoader:
+    """
+    Replaces a DataLoader on a subset (given by indices) of a DatasetCache
+    Batches are drawn by slicing a (shuffled) index tensor, there is no work per sample
+    """
+
+    def __init__(self, cache, indices, batch_size=100, shuffle=True):
+        self.cache = cache
+        self.indices = torch.as_tensor(indices, dtype=torch.long).to(cache.labels.device)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __len__(self):
+        return math.ceil(len(self.indices) / self.batch_size)
+
+    def __iter__(self):
+        indices = self.indices
+        if self.shuffle:
+            indices = indices[torch.randperm(len(indices)).to(indices.device)]
+        for batch in torch.split(indices, self.batch_size):
+            yield self.cache.batch(batch)
@@ -0,0 +1,192 @@
+import numpy as np
+
+from tools import limited_growth, feature_dissimilarity
+
+
+class DistanceCache:
+    """
+    Keeps the structural distances between the genomes of a population over the generations
+    Genomes are identified by Genome.fingerprint, so elites that are carried over are never compared again
+    and only the rows of new genomes are computed. Genomes that left the population are evicted on update.
+    The difference in training is always added fresh, it changes every generation.
+    hits/misses count the distances that were served from the cache/computed
+    """
+
+    def __init__(self, c=(5, 5, 5, 1, 5, 1)):
+        self.c = c
+        self.fingerprints = []
+        self.genomes = []
+        self.index = dict()
+        self.matrix = np.zeros((0, 0))
+        self.hits = 0
+        self.misses = 0
+
+    def update(self, genomes):
+        """
+        Cache exactly the given genomes and return the matrix of their dissimilarities
+        """
+        fingerprints = [g.fingerprint() for g in genomes]
+
+        # Evict genomes that left the population
+        alive = set(fingerprints)
+        keep = [i for i, fp in enumerate(self.fingerprints) if fp in alive]
+        self.fingerprints = [self.fingerprints[i] for i in keep]
+        self.genomes = [self.genomes[i] for i in keep]
+        self.index = {fp: i for i, fp in enumerate(self.fingerprints)}
+
+        # Only compute the rows of new genomes
+        new_genomes = []
+        for fp, g in zip(fingerprints, genomes):
+            if fp not in self.index:
+                self.index[fp] = len(self.fingerprints)
+                self.fingerprints += [fp]
+                new_genomes += [g]
+        self.genomes += new_genomes
+        n_kept, n_all = len(keep), len(self.genomes)
+        matrix = np.zeros((n_all, n_all))
+        matrix[:n_kept, :n_kept] = self.matrix[np.ix_(keep, keep)]
+        if len(new_genomes) > 0:
+            rows = structural_dissimilarity(new_genomes, self.genomes, c=self.c)
+            matrix[n_kept:, :] = rows
+            matrix[:n_kept, n_kept:] = rows[:, :n_kept].T
+        self.matrix = matrix
+        self.hits += n_kept ** 2
+        self.misses += n_all ** 2 - n_kept ** 2
+
+        rows = [self.index[fp] for fp in fingerprints]
+        return self.matrix[np.ix_(rows, rows)] + self.c[5] * training_dissimilarity(genomes)
+
+    def distance(self, genome, other):
+        """
+        Genome.dissimilarity of two genomes, computed directly if one of them is not cached
+        """
+        i, j = map(lambda g: self.index.get(g.fingerprint()), [genome, other])
+        if i is None or j is None:
+            self.misses += 1
+            return genome.dissimilarity(other, c=self.c)
+        self.hits += 1
+        return self.matrix[i, j] + self.c[5] * limited_growth(np.abs(genome.trained - other.trained), 1, 10)
+
+
+def pairwise_dissimilarity(genomes, others=None, c=(5, 5, 5, 1, 5, 1)):
+    """
+    Matrix of Genome.dissimilarity between every genome in genomes (rows) and in others (columns)
+    If others is not given, between all genomes
+    """
+    return structural_dissimilarity(genomes, others, c=c) + c[5] * training_dissimilarity(genomes, others)
+
+
+def training_dissimilarity(genomes, others=None):
+    """
+    X of Genome.dissimilarity - the difference in trained epochs
+    """
+    others = genomes if others is None else others
+    trained_1, trained_2 = map(lambda x: np.array([g.trained for g in x]), [genomes, others])
+    return limited_growth(np.abs(trained_1[:, None] - trained_2[None, :]), 1, 10)
+
+
+def structural_dissimilarity(genomes, others=None, c=(5, 5, 5, 1, 5, 1)):
+    """
+    (c0*S + c1*D + c2*E)/N + c3*T + c4*K of Genome.dissimilarity, everything that doesn't change by training
+    Genes and nodes are aligned by their innovation number, so all pairs are compared at once
+    """
+    others = genomes if others is None else others
+
+    # Genes
+    gene_ids = sorted(set().union(*[g.genes_by_id.keys() for g in genomes], *[g.genes_by_id.keys() for g in others]))
+    genes_1, genes_2 = map(lambda x: encode(x, gene_ids, 'genes_by_id'), [genomes, others])
+    S = np.zeros((len(genomes), len(others)))
+    for j in range(len(gene_ids)):
+        idx_1, idx_2 = [np.nonzero(genes[:, j])[0] for genes in [genes_1, genes_2]]
+        if len(idx_1) > 0 and len(idx_2) > 0:
+            S[np.ix_(idx_1, idx_2)] += block_dissimilarity(genes_1[idx_1, j], genes_2[idx_2, j])
+
+    # excess_start lies behind the genes of both genomes, so every gene that is not shared is disjoint
+    present_1, present_2 = map(lambda x: (x != None).astype(float), [genes_1, genes_2])
+    shared = present_1 @ present_2.T
+    D = present_1.sum(axis=1)[:, None] + present_2.sum(axis=1)[None, :] - 2 * shared
+    E = np.zeros_like(D)
+    N = 1
+
+    # Optimizer
+    T = block_dissimilarity([g.optimizer for g in genomes], [g.optimizer for g in others])
+
+    # Nodes differ by their merge
+    node_ids = sorted(set().union(*[g.nodes_by_id.keys() for g in genomes], *[g.nodes_by_id.keys() for g in others]))
+    nodes_1, nodes_2 = map(lambda x: encode(x, node_ids, 'nodes_by_id'), [genomes, others])
+    merges = set(n.merge for nodes in [nodes_1, nodes_2] for n in nodes.flat if n is not None)
+    shared_nodes = (nodes_1 != None).astype(float) @ (nodes_2 != None).astype(float).T
+    same_nodes = sum([merge_indicator(nodes_1, merge) @ merge_indicator(nodes_2, merge).T for merge in merges])
+    K = (shared_nodes - same_nodes) / shared_nodes
+
+    return (c[0] * S + c[1] * D + c[2] * E) / N + c[3] * T + c[4] * K
+
+
+def encode(genomes, ids, attr):
+    """
+    Object array of the genes/nodes of the genomes with one column per innovation number, None if missing
+    """
+    column = {_id: j for j, _id in enumerate(ids)}
+    encoded = np.full((len(genomes), len(ids)), None, dtype=object)
+    for i, g in enumerate(genomes):
+        for _id, obj in getattr(g, attr).items():
+            encoded[i, column[_id]] = obj
+    return encoded
+
+
+def merge_indicator(nodes, merge):
+    return np.array([[n is not None and n.merge == merge for n in row] for row in nodes], dtype=float)
+
+
+def block_dissimilarity(objects_1, objects_2):
+    """
+    The dissimilarity of all pairs of genes or optimizers, 1 if their classes differ
+    Classes without distance_features only equal themselves (like Gene)
+    """
+    classes_1, classes_2 = map(lambda x: [o.__class__ for o in x], [objects_1, objects_2])
+    block = np.ones((len(objects_1), len(objects_2)))
+    for cls in set(classes_1) & set(classes_2):
+        idx_1, idx_2 = map(lambda x: [i for i, k in enumerate(x) if k is cls], [classes_1, classes_2])
+        if hasattr(cls, 'distance_features'):
+            features_1, features_2 = map(lambda x: np.array([o.distance_features() for o in x], dtype=float),
+                                         [[objects_1[i] for i in idx_1], [objects_2[i] for i in idx_2]])
+            block[np.ix_(idx_1, idx_2)] = feature_dissimilarity(features_1[:, None, :], features_2[None, :, :],
+                                                                cls.distance_importance, cls.distance_relevance,
+                                                                cls.distance_categorical)
+        else:
+            block[np.ix_(idx_1, idx_2)] = [[objects_1[i] is not objects_2[j] for j in idx_2] for i in idx_1]
+    return block
+
+
+if __name__ == '__main__':
+    import random
+    import time
+
+    from genome import Genome
+    from tools import SyntheticPopulation
+
+    random.seed(0)
+    np.random.seed(0)
+    population = SyntheticPopulation()
+    for n in [50, 200, 1000]:
+        genomes = [Genome(population) for _ in range(n)]
+        for _ in range(10):
+            this_gen_mutations = dict()
+            for g in genomes:
+                g.mutate_random(this_gen_mutations)
+                g.trained = random.randrange(10)
+
+        start = time.time()
+        distances = pairwise_dissimilarity(genomes)
+        vectorized = time.time() - start
+
+        # The scalar path is slow, time some rows and extrapolate
+        rows = min(n, 50)
+        start = time.time()
+        scalar = np.array([[genomes[i].dissimilarity(genomes[j]) for j in range(n)] for i in range(rows)])
+        scalar_time = (time.time() - start) * n / rows
+
+        print('n = %4d | scalar %8.3fs%s | vectorized %7.3fs | speedup %6.1fx | max abs diff %.2e' %
+              (n, scalar_time, '*' if rows < n else ' ', vectorized, scalar_time / vectorized,
+               np.max(np.abs(scalar - distances[:rows]))))
+    print('* extrapolated from 50 rows')
@@ -9,6 +9,7 @@ from optimizer import ADAMGene, SGDGene
 from node import Node
 from gene import KernelGene, PoolGene, DenseGene
 from net import build_net_from_genome
+from checkpoint import ShardedCheckpoint
 
 
 def decode(line):
@@ -108,7 +109,7 @@ def from_human_readable(evaluate, input_size, output_size):
                     genome.visualize(ax=ax, input_size=(1, 28, 28), dbug=True)
                     plt.show()
                     net, _, _ = build_net_from_genome(genome, input_size, output_size)
-                    evaluate(net)
+                    print(evaluate(net).report())
         return
 
 
@@ -118,7 +119,8 @@ def show_genomes(input_size, simultan=False):
     gens = input("generations ['all' / list separated by ' ']:")
     if gens == 'all':
         i = 1
-        while os.path.exists(os.path.join("checkpoints", checkpoint, "%02d.cp" % i)):
+        while ShardedCheckpoint().exists(checkpoint, i) or \
+                os.path.exists(os.path.join("checkpoints", checkpoint, "%02d.cp" % i)):
             i += 1
         generations = list(range(1, i))
     else:
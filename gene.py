@@ -2,7 +2,7 @@ import random
 import logging
 import numpy as np
 
-from tools import weighted_choice, random_choices, limited_growth
+from tools import weighted_choice, random_choices, feature_dissimilarity
 
 
 class Gene:
@@ -47,6 +47,10 @@ class Gene:
     def output_size(self, input_size):
         pass
 
+    # Number of parameters, forward FLOPs and activations (floats) per sample of the modules built from the gene
+    def cost(self, in_size):
+        return [0, 0, 0]
+
     # A Edge is decided to be added after. Returns what it should be.
     def add_after(self, id, id_in, id_out):
         return weighted_choice(*self.mutate_to)(id, id_in, id_out)
@@ -65,6 +69,11 @@ class KernelGene(Gene):
     Width, Height are arg for read_human_readable only
     """
 
+    # How the hyperparameters of distance_features weigh in dissimilarity
+    distance_importance = np.array([0.2, 0.2, 0.1, 0.05, 0.1, 0.35])
+    distance_relevance = np.array([5, 5, 3, 3, 5, 8])
+    distance_categorical = np.array([False, False, False, False, False, False])
+
     def __init__(self, id, id_in, id_out, size=[None, None], stride=None, padding=None,
                  depth_size_change=None, depth_mult=None, enabled=True, width=None, height=None,
                  net_parameters=None):
@@ -197,21 +206,28 @@ class KernelGene(Gene):
         out_height = ((in_height - (self.height - 1) + 2 * self.padding - 1) // self.stride) + 1
         return [out_depth, out_width, out_height]
 
+    def cost(self, in_size):
+        # Depthwise and pointwise convolution
+        [out_depth, out_width, out_height] = self.output_size(in_size)
+        hidden = in_size[0] * self.depth_mult
+        params = hidden * self.width * self.height + hidden * out_depth
+        flops = 2 * params * out_width * out_height
+        return [params, flops, (hidden + out_depth) * out_width * out_height]
+
     def copy(self, id=None, id_in=None, id_out=None):
         return KernelGene(id or self.id, id_in or self.id_in, id_out or self.id_out,
                           size=[self.width, self.height], stride=self.stride, padding=self.padding,
                           depth_size_change=self.depth_size_change, depth_mult=self.depth_mult,
-                          enabled=self.enabled, net_parameters=self.net_parameters)
+                          enabled=self.enabled, net_parameters=dict(self.net_parameters))
+
+    def distance_features(self):
+        return [self.height, self.width, self.stride, self.padding, self.depth_size_change, self.depth_mult]
 
     def dissimilarity(self, other):
         if not isinstance(other, self.__class__):
             return 1
-        dist = np.array([self.height - other.height, self.width - other.width,
-                         self.stride - other.stride, self.padding - other.padding,
-                         self.depth_size_change - other.depth_size_change, self.depth_mult - other.depth_mult])
-        importance = np.array([0.2, 0.2, 0.1, 0.05, 0.1, 0.35])
-        relevance = np.array([5, 5, 3, 3, 5, 8])
-        return np.sum(limited_growth(np.abs(dist), importance, relevance))
+        return feature_dissimilarity(np.array(self.distance_features()), np.array(other.distance_features()),
+                                     self.distance_importance, self.distance_relevance, self.distance_categorical)
 
 
 class PoolGene(Gene):
@@ -219,6 +235,11 @@ class PoolGene(Gene):
     Pooling Layers are edges of the graph
     Width, Height are arg for read_human_readable only
     """
+    # How the hyperparameters of distance_features weigh in dissimilarity
+    distance_importance = np.array([0.2, 0.2, 0.1, 0.1, 0.4])
+    distance_relevance = np.array([5, 5, 3, 3, 0.01])
+    distance_categorical = np.array([False, False, False, False, True])
+
     def __init__(self, id, id_in, id_out, pooling=None, size=[None, None], stride=None, padding=None, enabled=True,
                  width=None, height=None, net_parameters=None):
         super().__init__(id, id_in, id_out, mutate_to=self.init_mutate_to(),
@@ -338,20 +359,23 @@ class PoolGene(Gene):
         out_height = (in_height - (self.height - 1) + 2 * self.padding)
         return [out_depth, out_width, out_height]
 
+    def cost(self, in_size):
+        out_size = self.output_size(in_size)
+        return [0, int(np.prod(out_size)) * self.width * self.height, int(np.prod(out_size))]
+
     def copy(self, id=None, id_in=None, id_out=None):
         return PoolGene(id or self.id, id_in or self.id_in, id_out or self.id_out,
                         size=[self.width, self.height], pooling=self.pooling, padding=self.padding, stride=self.stride,
-                        enabled=self.enabled, net_parameters=self.net_parameters)
+                        enabled=self.enabled, net_parameters=dict(self.net_parameters))
+
+    def distance_features(self):
+        return [self.height, self.width, self.stride, self.padding, self.possible_pooling.index(self.pooling)]
 
     def dissimilarity(self, other):
         if not isinstance(other, self.__class__):
             return 1
-        dist = np.array([self.height - other.height, self.width - other.width,
-                         self.stride - other.stride, self.padding - other.padding,
-                         self.pooling != other.pooling])
-        importance = np.array([0.2, 0.2, 0.1, 0.1, 0.4])
-        relevance = np.array([5, 5, 3, 3, 0.01])
-        return np.sum(limited_growth(np.abs(dist), importance, relevance))
+        return feature_dissimilarity(np.array(self.distance_features()), np.array(other.distance_features()),
+                                     self.distance_importance, self.distance_relevance, self.distance_categorical)
 
 
 class DenseGene(Gene):
@@ -361,6 +385,11 @@ class DenseGene(Gene):
     so the number of hidden neurons per layer it determined by the distance to the layer before
     """
 
+    # How the hyperparameters of distance_features weigh in dissimilarity
+    distance_importance = np.array([0.6, 0.4])
+    distance_relevance = np.array([80, 0.01])
+    distance_categorical = np.array([False, True])
+
     def __init__(self, id, id_in, id_out, size_change=None, activation=None, enabled=True, net_parameters=None):
         super().__init__(id, id_in, id_out, mutate_to=self.init_mutate_to(),
                          enabled=enabled, net_parameters=net_parameters)
@@ -418,15 +447,22 @@ class DenseGene(Gene):
 
         return [in_size[0], in_size[1], in_size[2] + self.size_change]
 
+    def cost(self, in_size):
+        # Linear layer and activation
+        out_features = self.output_size(in_size)[2]
+        params = in_size[2] * out_features + out_features
+        rows = in_size[0] * in_size[1]
+        return [params, rows * (2 * in_size[2] * out_features + out_features), rows * 2 * out_features]
+
     def copy(self, id=None, id_in=None, id_out=None):
         return DenseGene(id or self.id, id_in or self.id_in, id_out or self.id_out, size_change=self.size_change,
-                         activation=self.activation, enabled=self.enabled, net_parameters=self.net_parameters)
+                         activation=self.activation, enabled=self.enabled, net_parameters=dict(self.net_parameters))
+
+    def distance_features(self):
+        return [self.size_change, self.possible_activations.index(self.activation)]
 
     def dissimilarity(self, other):
         if not isinstance(other, self.__class__):
             return 1
-        dist = np.array([self.size_change - other.size_change,
-                         self.activation != other.activation])
-        importance = np.array([0.6, 0.4])
-        relevance = np.array([80, 0.01])
-        return np.sum(limited_growth(np.abs(dist), importance, relevance))
\ No newline at end of file
+        return feature_dissimilarity(np.array(self.distance_features()), np.array(other.distance_features()),
+                                     self.distance_importance, self.distance_relevance, self.distance_categorical)
\ No newline at end of file
@@ -1,4 +1,5 @@
 import random
+import hashlib
 import networkx as nx
 import numpy as np
 
@@ -8,6 +9,82 @@ from gene import Gene, KernelGene, PoolGene, DenseGene
 from optimizer import SGDGene, ADAMGene
 
 
+class GenomeGraph:
+    """
+    Adjacency index of the genes of a genome, updated by the mutations instead of scanning all genes
+    -----
+    in_edges/out_edges - node id -> ids of the genes into/out of the node, in the order of Genome.genes
+    enabled            - ids of the enabled genes, change them with set_enabled only
+    Reachability and the topological order are cached until the graph changes
+    """
+
+    def __init__(self, nodes, genes):
+        self.in_edges = dict()
+        self.out_edges = dict()
+        self.ends = dict()
+        self.edges = set()
+        self.enabled = set()
+        self.depths = dict()
+        self.reachable_from = dict()
+        self.order = None
+        for node in nodes:
+            self.add_node(node)
+        for gene in genes:
+            self.add_gene(gene)
+
+    def add_node(self, node):
+        self.in_edges.setdefault(node.id, [])
+        self.out_edges.setdefault(node.id, [])
+        self.depths[node.id] = node.depth
+        self.order = None
+
+    def add_gene(self, gene):
+        self.in_edges.setdefault(gene.id_out, []).append(gene.id)
+        self.out_edges.setdefault(gene.id_in, []).append(gene.id)
+        self.ends[gene.id] = (gene.id_in, gene.id_out)
+        self.edges.add((gene.id_in, gene.id_out))
+        if gene.enabled:
+            self.enabled.add(gene.id)
+        self.reachable_from = dict()
+
+    def set_enabled(self, gene, enabled):
+        gene.enabled = enabled
+        if enabled:
+            self.enabled.add(gene.id)
+        else:
+            self.enabled.discard(gene.id)
+        self.reachable_from = dict()
+
+    def has_edge(self, id_in, id_out):
+        return (id_in, id_out) in self.edges
+
+    def enabled_in(self, node_id):
+        return [_id for _id in self.in_edges[node_id] if _id in self.enabled]
+
+    def enabled_out(self, node_id):
+        return [_id for _id in self.out_edges[node_id] if _id in self.enabled]
+
+    def reachable(self, id_s):
+        """ Ids of all nodes reachable from node id_s over enabled genes (including id_s) """
+        if id_s not in self.reachable_from:
+            reached = {id_s}
+            stack = [id_s]
+            while len(stack) > 0:
+                for _id in self.enabled_out(stack.pop()):
+                    id_out = self.ends[_id][1]
+                    if id_out not in reached:
+                        reached.add(id_out)
+                        stack.append(id_out)
+            self.reachable_from[id_s] = reached
+        return self.reachable_from[id_s]
+
+    def topological_order(self):
+        """ Node ids sorted by depth, every gene goes from a lower to a higher depth """
+        if self.order is None:
+            self.order = sorted(self.depths, key=lambda _id: self.depths[_id])
+        return self.order
+
+
 class Genome:
     """
     Indirect representation of a feed-forward convolutional net.
@@ -21,22 +98,47 @@ class Genome:
     Shape and Number of neurons in a node are only decoded indirectly
     """
 
+    # What training measures besides parameters, send back from worker processes and cached with results
+    training_stats = ['memory', 'inherited', 'latency', 'curve', 'curve_offset', 'predicted', 'precision_stats',
+                      'timings']
+
     def __init__(self, population, optimizer=None, nodes_and_genes=None, nodes=None, genes=None, trained=0, reward=0,
-                 acc=None, net_parameters=None, loss=float('inf'), no_change=0):
+                 acc=None, net_parameters=None, loss=float('inf'), no_change=0, history=None):
         self.population = population
         self.optimizer = optimizer or self.init_optimizer()
 
         self.nodes, self.genes = nodes_and_genes or self.init_genome()\
             if nodes is None or genes is None else [nodes, genes]
         self.genes_by_id, self.nodes_by_id = self.dicts_by_id()
+        self.graph = GenomeGraph(self.nodes, self.genes)
 
         # These are set after training. For checkpointing and to be used by elite genomes
         self.net_parameters = net_parameters
         self.acc = acc
+        # Peak memory and fraction of inherited parameters (see inherit_parameters) of the last training
+        # and acc etc. of every generation trained
+        self.memory = None
+        self.inherited = None
+        # Estimated size of the net (see estimate_cost) and measured inference seconds per batch
+        self.cost = None
+        self.latency = None
+        # Section losses of the last training, the sections trained before it and the acc predicted if it was
+        # stopped (see train_on_data)
+        self.curve = []
+        self.curve_offset = 0
+        self.predicted = None
+        # Precision mode, training throughput and acc of the last training (see train_on_data, evaluate_genome)
+        self.precision_stats = None
+        # Seconds spent building, training and evaluating the net of the last training (see train_genome)
+        self.timings = None
+        self.history = history or []
 
         # Early stopping etc.
         self.loss = loss
         self.trained = trained
+        # What trained would be after the full budget of this generation, genomes are scored on it
+        # (see Population.schedule_training)
+        self.trained_budget = None
         self.no_change = no_change
 
         # Get extra training if good performance
@@ -51,7 +153,7 @@ class Genome:
         return self.population.next_id()
 
     def save(self, parameters=True):
-        saved = [(self.optimizer.__class__, self.optimizer.save()),
+        saved = [(self.optimizer.__class__, self.optimizer.save(parameters=parameters)),
                  [(node.__class__, node.id, node.depth, node.save()) for node in self.nodes],
                  [(g.__class__, g.id, g.id_in, g.id_out, g.save()) for g in self.genes],
                  self.acc, self.loss, self.trained, self.no_change, self.reward]
@@ -76,16 +178,15 @@ class Genome:
         self.nodes = [node[0](node[1], node[2]).load(node[3]) for node in saved_nodes]
         self.genes = [g[0](g[1], g[2], g[3]).load(g[4]) for g in saved_genes]
         self.genes_by_id, self.nodes_by_id = self.dicts_by_id()
+        self.graph = GenomeGraph(self.nodes, self.genes)
         return self
 
     def dicts_by_id(self):
-        genes_by_id = dict()
-        for gene in self.genes:
-            genes_by_id = {**genes_by_id, **{gene.id: gene}}
-        nodes_by_id = dict()
-        for node in self.nodes:
-            nodes_by_id = {**nodes_by_id, **{node.id: node}}
-        return [genes_by_id, nodes_by_id]
+        return [{gene.id: gene for gene in self.genes}, {node.id: node for node in self.nodes}]
+
+    def sorted_nodes(self):
+        """ Nodes in topological order (by depth) """
+        return [self.nodes_by_id[_id] for _id in self.graph.topological_order()]
 
     def init_genome(self):
         return [[Node(0, 0, role='input'), Node(1, 1, role='flatten'), Node(2, 2, role='output')],
@@ -105,7 +206,8 @@ class Genome:
         mutate = np.random.rand(len(self.genes)) < p
         for i, gene in enumerate(self.genes):
             if mutate[i]:
-                self.genes[i] = gene.mutate_random(exception)
+                # Can be a new gene object with the same id and nodes
+                self.genes[i] = self.genes_by_id[gene.id] = gene.mutate_random(exception)
 
     def mutate_nodes(self, p, exception):
         mutate = np.random.rand(len(self.nodes)) < p * exception
@@ -113,18 +215,13 @@ class Genome:
             if mutate[i]:
                 node.mutate_random()
 
-    def dfs(self, id_s, id_t, pre=None):
-        # depth first search in feed-forward net
-        if id_s == id_t:
-            return True
-        neig = [gene.id_out for gene in self.genes if gene.id_in == id_s and gene.enabled]
-        if len(neig) == 0:
-            return False
+    def dfs(self, id_s, id_t):
+        # Whether id_t is reachable from id_s over enabled genes
+        return id_t in self.graph.reachable(id_s)
 
-        for p in neig:
-            if self.dfs(p, id_t, pre=id_s):
-                return True
-        return False
+    def set_enabled(self, gene, enabled):
+        """ Enable or disable a gene, keeps the graph index up to date """
+        self.graph.set_enabled(gene, enabled)
 
     def disable_edge(self, gene):
         """
@@ -132,9 +229,9 @@ class Genome:
         Does nothing if no other connection to output exists.
         Returns whether deletion was successful
         """
-        gene.enabled = False
+        self.set_enabled(gene, False)
         if self.dfs(0, 2) is False:
-            gene.enabled = True
+            self.set_enabled(gene, True)
             return False
         return True
 
@@ -149,7 +246,7 @@ class Genome:
     def enable_edge(self):
         disabled_edges = [gene for gene in self.genes if not gene.enabled]
         if len(disabled_edges) > 0:
-            random.choice(disabled_edges).enabled = True
+            self.set_enabled(random.choice(disabled_edges), True)
 
     def split_edge(self, this_gen_mutations):
         enabled_edges = [gene for gene in self.genes if gene.enabled]
@@ -167,12 +264,15 @@ class Genome:
             new_node = Node(id1, depth)
             new_edge_1 = edge.copy(id2, edge.id_in, new_node.id)
             new_edge_2 = edge.add_after(id3, new_node.id, edge.id_out)
-            edge.enabled = False
+            self.set_enabled(edge, False)
             self.nodes += [new_node]
             self.genes += [new_edge_1, new_edge_2]
             self.nodes_by_id[id1] = new_node
             self.genes_by_id[id2] = new_edge_1
             self.genes_by_id[id3] = new_edge_2
+            self.graph.add_node(new_node)
+            self.graph.add_gene(new_edge_1)
+            self.graph.add_gene(new_edge_2)
 
     def add_edge(self):
         if len(self.nodes) >= 2:
@@ -182,13 +282,14 @@ class Genome:
                 if n1.depth > n2.depth:
                     n1, n2 = n2, n1
                 # only if this is a feed-forward edge that does exist
-                if n1.depth == n2.depth or [n1.id, n2.id] in [[e.id_in, e.id_out] for e in self.genes]:
+                if n1.depth == n2.depth or self.graph.has_edge(n1.id, n2.id):
                     tries -= 1
                     continue
                 id = self.next_id()
                 new_edge = weighted_choice([KernelGene, PoolGene, DenseGene], [1, 1, 1])(id, n1.id, n2.id)
                 self.genes += [new_edge]
                 self.genes_by_id[id] = new_edge
+                self.graph.add_gene(new_edge)
                 break
 
     def mutate_random(self, this_gen_mutations, exception=0.2):
@@ -231,7 +332,7 @@ class Genome:
 
     # Groups nodes by feed-forward layers
     def group_by(self):
-        nodes = sorted(self.nodes, key=lambda x: x.depth)
+        nodes = self.sorted_nodes()
         grouped = []
         group = []
         c = []
@@ -242,7 +343,7 @@ class Genome:
                 c = []
             else:
                 group += [n]
-            c += [edge.id_out for edge in self.genes if edge.id_in == n.id and edge.enabled]
+            c += [self.graph.ends[_id][1] for _id in self.graph.enabled_out(n.id)]
         if len(group) > 0:
             grouped.append(group)
         return grouped
@@ -270,25 +371,71 @@ class Genome:
             node.size = None
         if input_size is None:
             return
-        nodes = sorted(self.nodes, key=lambda x: x.depth)
+        nodes = self.sorted_nodes()
         self.nodes_by_id[0].size = input_size
         self.nodes_by_id[0].target_size = input_size
         outputs_by_id = {0: input_size}
         for node in nodes:
             # All reachable incoming edges that are enabled
-            in_edges = [edge for edge in self.genes if edge.enabled and edge.id_in in outputs_by_id.keys()
-                        and edge.id_out == node.id]
+            in_edges = [self.genes_by_id[_id] for _id in self.graph.enabled_in(node.id)
+                        if self.graph.ends[_id][0] in outputs_by_id]
             if len(in_edges) > 0:
                 in_sizes = [edge.output_size(outputs_by_id[edge.id_in]) for edge in in_edges]
                 node.size = node.output_size(in_sizes)
                 outputs_by_id[node.id] = node.size
 
+    def estimate_cost(self, input_size, output_size):
+        """
+        Static cost of the net from the sizes (see set_sizes), without building it. Saved in self.cost
+        params            - number of parameters
+        flops             - forward FLOPs per sample
+        activation_memory - bytes of all (float32) activations per sample, gradients of training not included
+        """
+        self.set_sizes(input_size)
+        params, flops, activations = 0, 0, 0
+        for gene in self.genes:
+            if gene.enabled and self.nodes_by_id[gene.id_in].size is not None:
+                gene_params, gene_flops, gene_activations = gene.cost(self.nodes_by_id[gene.id_in].size)
+                params, flops, activations = params + gene_params, flops + gene_flops, activations + gene_activations
+        for node in self.nodes:
+            if node.size is not None and node.role != 'input':
+                # Merging
+                merged = int(np.prod(node.target_size))
+                flops, activations = flops + merged, activations + merged
+                if node.role == 'output':
+                    params += merged * output_size + output_size
+                    flops, activations = flops + 2 * merged * output_size, activations + output_size
+        self.cost = {'params': params, 'flops': flops, 'activation_memory': 4 * activations}
+        return self.cost
+
     def copy(self):
         return Genome(self.population, optimizer=self.optimizer.copy(),
                       nodes_and_genes=[[node.copy() for node in self.nodes],
                                        [gene.copy() for gene in self.genes]],
                       net_parameters=self.net_parameters.copy() if self.net_parameters is not None else None,
-                      no_change=self.no_change, loss=self.loss, trained=self.trained, acc=self.acc)
+                      no_change=self.no_change, loss=self.loss, trained=self.trained, acc=self.acc,
+                      history=list(self.history))
+
+    def fingerprint(self):
+        """
+        Everything except training the dissimilarity to other genomes depends on (the key of the DistanceCache)
+        """
+        return (self.optimizer.__class__.__name__, tuple(self.optimizer.distance_features()),
+                tuple((node.id, node.merge) for node in sorted(self.nodes, key=lambda x: x.id)),
+                tuple((gene.id, gene.__class__.__name__,
+                       tuple(gene.distance_features()) if hasattr(gene, 'distance_features') else id(gene))
+                      for gene in sorted(self.genes, key=lambda x: x.id)))
+
+    def structural_hash(self):
+        """
+        Hash of everything the net and its training depend on, the same in every process:
+        the optimizer, the nodes and the enabled genes (the key of the ResultCache together with the training budget)
+        """
+        structure = (self.optimizer.__class__.__name__, self.optimizer.save(parameters=False),
+                     [(node.id, node.merge) for node in sorted(self.nodes, key=lambda x: x.id)],
+                     [(gene.id, gene.id_in, gene.id_out, gene.__class__.__name__, gene.save())
+                      for gene in sorted(self.genes, key=lambda x: x.id) if gene.enabled])
+        return hashlib.sha1(repr(structure).encode()).hexdigest()
 
     def dissimilarity(self, other, c=(5, 5, 5, 1, 5, 1)):
         """
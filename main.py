@@ -6,21 +6,16 @@ import torchvision
 from convNEAT import ConvNEAT
 
 
-def mnist(torch_device):
-    # Build datasets
+def mnist():
+    # Build datasets, moving to the device is done by the data loaders (see dataset.DatasetCache)
     transform = torchvision.transforms.Compose([
         torchvision.transforms.ToTensor(),
-        torchvision.transforms.Lambda(
-            lambda x: x.to(device=torch_device)),
         torchvision.transforms.Normalize((1 / 2,), (1 / 2,)),
     ])
-    target_transform = torchvision.transforms.Lambda(lambda x: torch.tensor(x, device=torch_device))
     data_train = torchvision.datasets.MNIST(
-        'data', train=True, transform=transform,
-        target_transform=target_transform, download=True)
+        'data', train=True, transform=transform, download=True)
     data_test = torchvision.datasets.MNIST(
-        'data', train=False, transform=transform,
-        target_transform=target_transform, download=True)
+        'data', train=False, transform=transform, download=True)
     return data_train, data_test
 
 
@@ -30,7 +25,7 @@ if __name__ == '__main__':
     # Train on GPU
     torch_device = 'cuda' if torch.cuda.is_available() else 'cpu'
     # The dataset
-    data_train, data_test = mnist(torch_device)
+    data_train, data_test = mnist()
 
     # train
     trainer = ConvNEAT(output_size=10, n=20, torch_device=torch_device, name='test_run_3', seed=20)
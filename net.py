@@ -1,5 +1,7 @@
+import functools
 import logging
 import math
+import time
 import numpy as np
 import torch
 from pprint import pprint
@@ -9,25 +11,48 @@ from optimizer import SGDGene, ADAMGene
 from tools import check_cuda_memory
 
 
-def build_net_from_genome(genome, input_size, output_size):
+# Data types of the precision modes, fp32 runs without autocast
+PRECISIONS = {'fp32': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def precision_mode(precision, torch_device):
+    """ The precision used on the device, fp16 (with a GradScaler) needs cuda, elsewhere bf16 is used instead """
+    if precision not in PRECISIONS:
+        raise ValueError('Precision %s not supported' % precision)
+    if precision == 'fp16' and torch.device(torch_device).type != 'cuda':
+        logging.debug('fp16 needs cuda, using bf16 on %s' % torch_device)
+        return 'bf16'
+    return precision
+
+
+def autocast(torch_device, precision):
+    """ Context that runs the ops of a net in precision (see precision_mode) """
+    return torch.autocast(torch.device(torch_device).type, dtype=PRECISIONS[precision], enabled=precision != 'fp32')
+
+
+def to_memory_format(inputs, channels_last):
+    """ Images as channels_last (NHWC in memory) if wanted, the shape stays NCHW """
+    if channels_last and inputs.dim() == 4:
+        return inputs.contiguous(memory_format=torch.channels_last)
+    return inputs
+
+
+def build_net_from_genome(genome, input_size, output_size, compiled=False, debug=None):
     """
     Build net from genome, using the old weights if a elite gene or the weights of the genes (i.e. Kernel/Pool)
     Using the optimizer and hyperparameters specified in the gene
+    compiled - run the net with a static execution plan (see Net.compile)
+    debug    - trace shapes and timings of every batch (see Net.forward_debug)
     """
-    net = Net(genome, input_size=input_size, output_size=output_size)
+    net = Net(genome, input_size=input_size, output_size=output_size, compiled=compiled, debug=debug)
 
     # Load saved parameters
-    net_dict = net.state_dict()
     if genome.net_parameters is not None:
         net.load_state_dict(genome.net_parameters)
+        genome.inherited = 1.
     else:
-        # TODO
-        """
-        all_net_parameters = {k: v for gene in genome.genes for k, v in gene.net_parameters.items()
-                              if k in net_dict}
-        net_dict.update(all_net_parameters)
-        net.load_state_dict(net_dict)
-        """
+        genome.inherited = inherit_parameters(net, genome)
+        logging.info('Inherited %.1f%% of the parameters' % (100 * genome.inherited))
 
     criterion = torch.nn.CrossEntropyLoss()
 
@@ -52,75 +77,162 @@ def build_net_from_genome(genome, input_size, output_size):
 
 def train_on_data(genome, net, optimizer, criterion, epochs, torch_device, data_loader_train,
                   n_epochs_no_change=3, tol=1e-5, save_net_param=True, save_gene_param=True,
-                  move=True, move_back=False):
+                  move=True, move_back=False, predictor=None, precision='fp32', channels_last=False):
     """
     Train net
     Stop when in <n_epochs_no_change> no improvement by at least <tol> is made
-    Stop when nan occurs for 5 consecutive sections (1/10 of epoch)
+    Stop when nan occurs for 5 consecutive sections (1/10 of epoch), also the ones of a reduced precision
+    Stop when predictor(section losses, sections trained before them, sections per epoch) returns a predicted acc
+    (see LearningCurves.stop), it is saved in genome.predicted
+    The loss is summed on the device and only read at the end of a section, so batches aren't synchronized
+    The mean loss of every section is saved in genome.curve, in genome.curve_offset how many sections the genome was
+    trained before (in earlier generations or rungs), so curves of genomes that continue training line up
+    precision     - fp32, bf16 (autocast) or fp16 (autocast and GradScaler, only on cuda, see precision_mode)
+    channels_last - run the net and the images in channels_last memory format
+    The mode and the training throughput are saved in genome.precision_stats
 
     Updates values in genomes that are relevant for this
     """
+    train_together([genome], [net], [optimizer], [criterion], [epochs], torch_device, data_loader_train,
+                   n_epochs_no_change=n_epochs_no_change, tol=tol, save_net_param=save_net_param,
+                   save_gene_param=save_gene_param, move=move, move_back=move_back, predictors=[predictor],
+                   precision=precision, channels_last=channels_last)
+
+
+def train_together(genomes, nets, optimizers, criterions, epochs, torch_device, data_loader_train,
+                   n_epochs_no_change=3, tol=1e-5, save_net_param=True, save_gene_param=True,
+                   move=True, move_back=False, predictors=None, precision='fp32', channels_last=False):
+    """
+    Train several nets on the same batches, so one pass over the data serves all of them
+    Small nets leave the device idle between their kernels, running them one after another on a batch fills it
+    Every genome keeps its own optimizer, criterion, epochs, predictor and stopping (see train_on_data),
+    a stopped net leaves the loop while the others go on
+    """
     if move:
-        net.to(torch_device)
+        for net in nets:
+            net.to(torch_device)
+    precision = precision_mode(precision, torch_device)
+    if channels_last:
+        for net in nets:
+            net.to(memory_format=torch.channels_last)
+    # Without fp16 the scalers do nothing
+    scalers = [torch.amp.GradScaler(torch.device(torch_device).type, enabled=precision == 'fp16') for _ in nets]
+    seconds = [0.] * len(genomes)
+    samples = [0] * len(genomes)
 
     print('Beginning training')
 
     # 10 Sections of size n
-    n = len(data_loader_train) // 10
-    nan_sections = 0
-
-    for epoch in range(epochs):
-        epoch_loss = 0.
-        batch_loss = 0.
+    n = max(1, len(data_loader_train) // 10)
+    sections = len(data_loader_train) // n
+    predictors = predictors or [None] * len(genomes)
+    nan_sections = [0] * len(genomes)
+    aborted = set()
+    for genome in genomes:
+        genome.curve = []
+        genome.curve_offset = genome.trained * sections
+        genome.predicted = None
+    active = [j for j in range(len(genomes)) if epochs[j] > 0]
+    tag = (lambda j: ' (net %d)' % j) if len(genomes) > 1 else (lambda j: '')
+
+    for epoch in range(max(epochs, default=0)):
+        if len(active) == 0:
+            break
+        epoch_loss = [0.] * len(genomes)
+        section_loss = [0.] * len(genomes)
         for i, (inputs, labels) in enumerate(data_loader_train):
-            optimizer.zero_grad()
-            outputs = net(inputs)
-            loss = criterion(outputs, labels)
-            loss.backward()
-            optimizer.step()
-            epoch_loss += loss.item()
-            batch_loss += loss.item()
+            inputs, labels = to_memory_format(inputs.to(torch_device), channels_last), labels.to(torch_device)
+            for j in active:
+                start = time.perf_counter()
+                optimizers[j].zero_grad()
+                with autocast(torch_device, precision):
+                    outputs = nets[j](inputs)
+                    loss = criterions[j](outputs, labels)
+                scalers[j].scale(loss).backward()
+                scalers[j].step(optimizers[j])
+                scalers[j].update()
+                section_loss[j] = section_loss[j] + loss.detach()
+                seconds[j] += time.perf_counter() - start
+                samples[j] += len(labels)
 
             # Print the section
             if (i + 1) % n == 0:
-                print('[%d, %3d] loss: %.3f' % (epoch, i + 1, batch_loss / n))
-                # Stop if only nans appear
-                if np.isnan(batch_loss / n):
-                    nan_sections += 1
-                    if nan_sections == 5:
-                        # Quit without saving net parameters
-                        if move_back:
-                            net.to('cpu')
-                        return
-                else:
-                    nan_sections = 0
-                batch_loss = 0.
-
-        epoch_loss_mean = epoch_loss / len(data_loader_train)
-        print('[%d] loss: %.3f' % (epoch, epoch_loss_mean))
-
-        # Early stopping
-        genome.trained += 1
-        if epoch_loss_mean < genome.loss - tol:
-            genome.loss = epoch_loss_mean
-            genome.no_change = 0
-        else:
-            genome.no_change += 1
-            if genome.no_change >= n_epochs_no_change:
-                # Get one epoch to improve next generation
-                genome.no_change -= 1
-                break
+                for j in list(active):
+                    genome = genomes[j]
+                    batch_loss = float(section_loss[j])
+                    epoch_loss[j] += batch_loss
+                    section_loss[j] = 0.
+                    print('[%d, %3d] loss: %.3f%s' % (epoch, i + 1, batch_loss / n, tag(j)))
+                    genome.curve += [batch_loss / n]
+                    # Stop if only nans appear
+                    if np.isnan(batch_loss / n):
+                        nan_sections[j] += 1
+                        if nan_sections[j] == 5:
+                            # Quit without saving net parameters
+                            logging.info('Stopped training after 5 nan sections in %s' % precision)
+                            aborted.add(j)
+                            active.remove(j)
+                            continue
+                    else:
+                        nan_sections[j] = 0
+
+                    # Stop if it won't get good enough
+                    if predictors[j] is not None:
+                        genome.predicted = predictors[j](genome.curve, genome.curve_offset, sections)
+                        if genome.predicted is not None:
+                            logging.info('Stopped training after %d sections, predicted acc %.4f' %
+                                         (len(genome.curve), genome.predicted))
+                            active.remove(j)
+                if len(active) == 0:
+                    break
+
+        for j in list(active):
+            genome = genomes[j]
+            # Batches after the last section
+            epoch_loss[j] += float(section_loss[j])
+            epoch_loss_mean = epoch_loss[j] / len(data_loader_train)
+            print('[%d] loss: %.3f%s' % (epoch, epoch_loss_mean, tag(j)))
+
+            # Early stopping
+            genome.trained += 1
+            if epoch_loss_mean < genome.loss - tol:
+                genome.loss = epoch_loss_mean
+                genome.no_change = 0
+            else:
+                genome.no_change += 1
+                if genome.no_change >= n_epochs_no_change:
+                    # Get one epoch to improve next generation
+                    genome.no_change -= 1
+                    active.remove(j)
+                    continue
+            if epoch + 1 >= epochs[j]:
+                active.remove(j)
 
     print('Finished training')
 
-    if move_back:
-        net.to('cpu')
-        optimizer.to('cpu')
-
-    # Save weights and bias for conv/pool
+    for j, (genome, net, optimizer) in enumerate(zip(genomes, nets, optimizers)):
+        # Batches aren't synchronized, on cuda this is the time to queue them
+        genome.precision_stats = {'precision': precision, 'channels_last': channels_last,
+                                  'samples': samples[j],
+                                  'samples_per_second': samples[j] / seconds[j] if seconds[j] > 0 else None,
+                                  'aborted': j in aborted}
+        if j in aborted:
+            if move_back:
+                net.to('cpu')
+            continue
+        if move_back:
+            net.to('cpu')
+            optimizer.to('cpu')
+        save_trained(genome, net, optimizer, save_net_param, save_gene_param)
+
+
+def save_trained(genome, net, optimizer, save_net_param=True, save_gene_param=True):
+    """ Save the trained weights in the genes and the net and optimizer state in the genome (on the cpu) """
+    # Save weights and bias for conv/pool/dense, not of the output layer
     if save_gene_param:
         for name, parameter in net.state_dict().items():
-            if name.startswith('conv') or name.startswith('pool'):
+            if name.startswith('conv') or name.startswith('pool') or \
+                    (name.startswith('dense') and not name.startswith('dense_out')):
                 _id = int(name.split('.')[0].split('_')[-1])
                 genome.genes_by_id[_id].net_parameters[name] = parameter.cpu()
 
@@ -142,66 +254,168 @@ def train_on_data(genome, net, optimizer, criterion, epochs, torch_device, data_
             genome.net_parameters[t] = genome.net_parameters[t].cpu()
 
 
-def evaluate(net, torch_device, data_loader_test, output_size, move=False, move_back=True):
+def inherit_parameters(net, genome):
+    """
+    Load the weights saved in the genes (see train_on_data) into the net, returns the fraction of parameters loaded
+    Weights are saved under the module name of the gene they were trained in, a copied gene (e.g. split_edge)
+    has a new id, so they are renamed to the gene's id. Weights that don't fit anymore keep their initialization.
+    """
+    net_dict = net.state_dict()
+    inherited = dict()
+    for gene in genome.genes:
+        for name, parameter in gene.net_parameters.items():
+            module, tensor = name.split('.', 1)
+            name = '%s_%03d.%s' % (module.rsplit('_', 1)[0], gene.id, tensor)
+            if name in net_dict and net_dict[name].shape == parameter.shape:
+                inherited[name] = parameter
+    net_dict.update(inherited)
+    net.load_state_dict(net_dict)
+    total = sum(parameter.numel() for parameter in net_dict.values())
+    return sum(parameter.numel() for parameter in inherited.values()) / total if total > 0 else 0.
+
+
+class Metrics:
+    """
+    What evaluate returns, computed from the confusion matrix (rows: labels, columns: predictions)
+    recall, precision and f1 are per class and nan for classes that never occur/are never predicted
+    """
+
+    def __init__(self, confusion):
+        self.confusion = confusion
+        self.class_total = np.sum(confusion, axis=1)
+        self.labeled_total = np.sum(confusion, axis=0)
+        self.class_correct = confusion.diagonal()
+        self.correct = int(np.sum(self.class_correct))
+        self.total = int(np.sum(self.class_total))
+        self.accuracy = self.correct / self.total if self.total > 0 else 0
+
+        # Ignore Warning if /0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.recall = self.class_correct / self.class_total
+            self.precision = self.class_correct / self.labeled_total
+            self.f1 = 2 * self.precision * self.recall / (self.precision + self.recall)
+
+    def __repr__(self):
+        return '<Metrics | acc=%.4f (%d / %d)>' % (self.accuracy, self.correct, self.total)
+
+    def report(self):
+        lines = ['%d: Recall: %5.2f %%  (%3d / %3d) - Precision %5.2f %% (%3d / %3d)- F1: %.3f' %
+                 (i, 100 * self.recall[i], self.class_correct[i], self.class_total[i],
+                  100 * self.precision[i], self.class_correct[i], self.labeled_total[i], self.f1[i])
+                 for i in range(len(self.confusion))]
+        lines += ['Accuracy of the network on the %d validation images: %5.2f %% (%d / %d)' %
+                  (self.total, 100 * self.accuracy, self.correct, self.total)]
+        return '\n'.join(lines)
+
+
+def evaluate(net, torch_device, data_loader_test, output_size, move=False, move_back=True, precision='fp32',
+             channels_last=False):
     """
-    Instantiate the neural network from the genome and train it for a set amount of epochs
-    Evaluate the accuracy on the test data and return this as the score.
-    If a monitor is set, visualize the net that is currently training.
+    Evaluate the accuracy etc. of a trained net on the test data, returns Metrics
+    The confusion matrix is accumulated on the device with bincount and only transferred once at the end.
+    precision, channels_last - run the net like in training (see train_on_data)
     """
     if move:
         net.to(torch_device)
+    precision = precision_mode(precision, torch_device)
+    if channels_last:
+        net.to(memory_format=torch.channels_last)
 
     print('Beginning evaluation')
-    confusion = np.zeros((output_size, output_size))
+    confusion = torch.zeros(output_size * output_size, dtype=torch.long, device=torch_device)
     with torch.no_grad():
         for inputs, labels in data_loader_test:
-            outputs = net(inputs)
+            inputs, labels = to_memory_format(inputs.to(torch_device), channels_last), labels.to(torch_device)
+            with autocast(torch_device, precision):
+                outputs = net(inputs)
             predictions = torch.argmax(outputs, dim=1)
-            for pre, lab in zip(predictions, labels):
-                confusion[lab, pre] += 1
+            confusion += torch.bincount(labels.to(predictions.device) * output_size + predictions,
+                                        minlength=output_size * output_size).to(confusion.device)
+    metrics = Metrics(confusion.view(output_size, output_size).cpu().numpy())
 
     if move_back:
         net.to('cpu')
 
-    print(confusion)
-    class_total = np.sum(confusion, axis=1)
-    labeled_total = np.sum(confusion, axis=0)
-    class_correct = confusion.diagonal()
-    correct = int(np.sum(class_correct))
-    total = int(np.sum(class_total))
-    acc = correct / total
-
-    # Ignore Warning if /0
-    np.seterr(divide='ignore', invalid='ignore')
-    for i in range(output_size):
-        rec = class_correct[i] / class_total[i]
-        pre = class_correct[i] / labeled_total[i]
-        print('%d: Recall: %5.2f %%  (%3d / %3d) - Precision %5.2f %% (%3d / %3d)- F1: %.3f' %
-              (i, 100 * rec, class_correct[i], class_total[i],
-               100 * pre, class_correct[i], labeled_total[i], 100 / (1 / pre + 1 / rec)))
-    print('Accuracy of the network on the %d validation images: %5.2f %% (%d / %d)' % (total, 100 * acc, correct, total))
-    print()
-    np.seterr(divide='warn', invalid='warn')
-
-    return acc
+    logging.debug(metrics.report())
+    print('Accuracy of the network on the %d validation images: %5.2f %% (%d / %d)\n' %
+          (metrics.total, 100 * metrics.accuracy, metrics.correct, metrics.total))
+
+    return metrics
+
+
+def benchmark_latency(net, input_size, batch_size=100, repeats=10, warmup=2, precision='fp32', channels_last=False):
+    """
+    Median seconds of inference on a batch of random inputs, on the device the net is on
+    precision, channels_last - run the net like in training (see train_on_data)
+    """
+    parameter = next(net.parameters(), None)
+    device = parameter.device if parameter is not None else torch.device('cpu')
+    precision = precision_mode(precision, device)
+    inputs = to_memory_format(torch.randn([batch_size] + list(input_size), device=device), channels_last)
+    training = net.training
+    net.eval()
+    times = []
+    with torch.no_grad(), autocast(device, precision):
+        for i in range(warmup + repeats):
+            start = NetTrace.time(inputs)
+            net(inputs)
+            times += [NetTrace.time(inputs) - start]
+    net.train(training)
+    return float(np.median(times[warmup:]))
+
+
+class NetTrace:
+    """
+    What happened at every node of a net built with debug=True during the last batch
+    records - per node: id, role, [edge id, shape before, shape after] of every incoming edge,
+              shapes after node preprocessing, output shape, expected size (decoded from the genome), seconds
+    """
+
+    def __init__(self):
+        self.records = []
+
+    def __repr__(self):
+        return '\n'.join(map(str, self.records))
+
+    def clear(self):
+        self.records = []
+
+    def record(self, node, edge_shapes, merged_shapes, out_shape, seconds):
+        record = {'node': node.id, 'role': node.role, 'edges': edge_shapes, 'merged': merged_shapes,
+                  'out': out_shape, 'expected': node.size, 'seconds': seconds}
+        self.records += [record]
+        return record
+
+    @staticmethod
+    def time(x):
+        # Wait for the gpu to get meaningful timings
+        if x.is_cuda:
+            torch.cuda.synchronize(x.device)
+        return time.perf_counter()
+
+    def total(self):
+        return sum(record['seconds'] for record in self.records)
 
 
 class Net(torch.nn.Module):
     """
     Build a feed-forward neural net with convolutions from a genome
+    compiled - run a static execution plan instead of interpreting the genome every batch (see compile)
+    debug    - record shapes and timings of every node in self.trace and check the sizes (see forward_debug)
+               by default only if logging is set to DEBUG when the net is built
     """
 
-    def __init__(self, genome, input_size, output_size):
+    def __init__(self, genome, input_size, output_size, compiled=False, debug=None):
         super().__init__()
         possible_activations = {'relu': torch.nn.functional.relu,
                                 'tanh': torch.tanh}
 
         genome.set_sizes(input_size)
-        self.nodes = sorted(genome.nodes, key=lambda n: n.depth)
+        self.nodes = genome.sorted_nodes()
         self.modules_by_id = dict()
         # All reachable incoming edges that are enabled
-        self.in_edges_by_node_id = {node.id: [edge for edge in genome.genes if edge.enabled and edge.id_out == node.id
-                                              and genome.nodes_by_id[edge.id_in].size is not None]
+        self.in_edges_by_node_id = {node.id: [genome.genes_by_id[_id] for _id in genome.graph.enabled_in(node.id)
+                                              if genome.nodes_by_id[genome.graph.ends[_id][0]].size is not None]
                                     for node in self.nodes}
 
         logging.debug('Building net Edges')
@@ -290,32 +504,198 @@ class Net(torch.nn.Module):
                      dense,
                      lambda x: torch.reshape(x, [x.shape[0], -1])]
 
+        self.plan = self.compile(genome) if compiled else None
+        if debug is None:
+            debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        self.trace = NetTrace() if debug else None
+
+    def compile(self, genome):
+        """
+        Turn the decoded genome into a static execution plan, a list of nodes in topological order
+        [output slot, [[input slot, edge modules, merge], ...], postprocessing]
+        Intermediate results are stored in a list of slots instead of a dict.
+        The sizes are known in advance, so merges are only done if they change the shape and use fixed sizes,
+        flatten and the output layer are fused into single reshapes.
+        Without data dependent control flow the plan can be traced by torch.jit.trace and torch.fx
+        """
+        slots = {0: 0}
+        plan = []
+        for node in self.nodes:
+            in_edges = self.in_edges_by_node_id[node.id]
+            if len(in_edges) == 0:
+                continue
+            edges = []
+            for gene in in_edges:
+                size = gene.output_size(genome.nodes_by_id[gene.id_in].size)
+                edges += [[slots[gene.id_in], self.modules_by_id[gene.id], self.merge(node, size)]]
+            if node.role == 'flatten':
+                post = [lambda x: torch.flatten(x, 1)[:, None, None, :]]
+            elif node.role == 'output':
+                dense = [m for m in self.modules_by_id[node.id] if isinstance(m, torch.nn.Linear)][0]
+                post = [functools.partial(torch.flatten, start_dim=1), dense]
+            else:
+                post = []
+            slots[node.id] = len(slots)
+            plan += [[slots[node.id], edges, post]]
+        self.output_slot = slots[2]
+        return plan
+
+    @staticmethod
+    def merge(node, size):
+        """ The node preprocessing for an input of the given size, None if it doesn't change anything """
+        [height, width] = node.target_size[1:]
+        if [height, width] == size[1:]:
+            return None
+        if node.merge in ['upsample', 'downsample', 'avgsample']:
+            return functools.partial(torch.nn.functional.interpolate, size=[height, width],
+                                     align_corners=False, mode='bilinear')
+        elif node.merge == 'padding':
+            return functools.partial(torch.nn.functional.pad,
+                                     pad=[math.floor((width - size[2]) / 2), math.ceil((width - size[2]) / 2),
+                                          math.floor((height - size[1]) / 2), math.ceil((height - size[1]) / 2)])
+        raise ValueError('Merge type %s not supported' % node.merge)
+
     def forward(self, x):
+        if self.trace is not None:
+            return self.forward_debug(x)
+        if self.plan is not None:
+            return self.forward_plan(x)
         outputs_by_id = {0: x}
         for node in self.nodes:
             # All reachable incoming edges that are enabled
             in_edges = self.in_edges_by_node_id[node.id]
             if len(in_edges) > 0:
-                logging.debug(node)
                 data_in = []
                 # Apply Edge Genes
                 for gene in in_edges:
                     y = outputs_by_id[gene.id_in]
-                    logging.debug(gene)
-                    logging.debug('shape before: %s' % str(y.shape))
                     for module in self.modules_by_id[gene.id]:
                         y = module(y)
-                    logging.debug('shape after: %s' % str(y.shape))
                     data_in += [y]
                 # node preprocessing
-                logging.debug('shape before: %s' % [data.shape for data in data_in])
                 data_in = list(map(self.modules_by_id[node.id][0], data_in))
-                logging.debug('shape after: %s' % [data.shape for data in data_in])
                 z = torch.cat(data_in, dim=1)
                 # node postprocessing
                 for f in self.modules_by_id[node.id][1:]:
                     z = f(z)
                 outputs_by_id[node.id] = z
+        return outputs_by_id[2]
+
+    def forward_debug(self, x):
+        """
+        Interpret the genome like forward, but record the shapes and timings of every node in self.trace
+        and check that the output sizes match the sizes decoded from the genome
+        """
+        self.trace.clear()
+        outputs_by_id = {0: x}
+        for node in self.nodes:
+            in_edges = self.in_edges_by_node_id[node.id]
+            if len(in_edges) > 0:
+                start = self.trace.time(x)
+                data_in = []
+                edge_shapes = []
+                for gene in in_edges:
+                    y = outputs_by_id[gene.id_in]
+                    for module in self.modules_by_id[gene.id]:
+                        y = module(y)
+                    data_in += [y]
+                    edge_shapes += [[gene.id, list(outputs_by_id[gene.id_in].shape), list(y.shape)]]
+                data_in = list(map(self.modules_by_id[node.id][0], data_in))
+                merged_shapes = [list(data.shape) for data in data_in]
+                z = torch.cat(data_in, dim=1)
+                for f in self.modules_by_id[node.id][1:]:
+                    z = f(z)
+                outputs_by_id[node.id] = z
+                record = self.trace.record(node, edge_shapes, merged_shapes, list(z.shape), self.trace.time(x) - start)
+                logging.debug(record)
                 if node.role != 'output' and list(z.shape)[1:] != node.size:
                     logging.error('output_size of node not matching: %s vs %s' % (list(z.shape[1:]), node.size))
-        return outputs_by_id[2]
\ No newline at end of file
+        return outputs_by_id[2]
+
+    def forward_plan(self, x):
+        outputs = [x] + [None] * len(self.plan)
+        for slot, edges, post in self.plan:
+            data_in = []
+            for in_slot, modules, merge in edges:
+                y = outputs[in_slot]
+                for module in modules:
+                    y = module(y)
+                if merge is not None:
+                    y = merge(y)
+                data_in += [y]
+            z = data_in[0] if len(data_in) == 1 else torch.cat(data_in, dim=1)
+            for f in post:
+                z = f(z)
+            outputs[slot] = z
+        return outputs[self.output_slot]
+
+
+if __name__ == '__main__':
+    import random
+
+    from genome import Genome
+    from tools import SyntheticPopulation
+
+    def train_synchronized(genome, net, optimizer, criterion, epochs, torch_device, data_loader_train, **kwargs):
+        """ The training loop before: reading the loss after every batch """
+        for epoch in range(epochs):
+            for inputs, labels in data_loader_train:
+                optimizer.zero_grad()
+                loss = criterion(net(inputs), labels)
+                loss.backward()
+                optimizer.step()
+                loss.item()
+                loss.item()
+
+    # Steps per second for the minimal genome and a big mutated one on random data
+    random.seed(0)
+    np.random.seed(0)
+    torch.manual_seed(0)
+    torch_device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    data_loader_train = [(torch.randn(100, 1, 28, 28, device=torch_device),
+                          torch.randint(10, (100,), device=torch_device)) for _ in range(20)]
+    population = SyntheticPopulation()
+    small = Genome(population)
+    large = Genome(population)
+    while len([gene for gene in large.genes if gene.enabled]) < 12:
+        large.mutate_random(dict())
+    for name, genome in [('small', small), ('large', large)]:
+        for train in [train_synchronized, train_on_data]:
+            net, optimizer, criterion = build_net_from_genome(genome, [1, 28, 28], 10)
+            net.to(torch_device)
+            start = time.time()
+            train(genome, net, optimizer, criterion, epochs=2, torch_device=torch_device,
+                  data_loader_train=data_loader_train, n_epochs_no_change=3, save_net_param=False,
+                  save_gene_param=False)
+            if torch_device == 'cuda':
+                torch.cuda.synchronize()
+            print('%s genome - %-18s %7.1f steps/s on %s' %
+                  (name, train.__name__, 2 * len(data_loader_train) / (time.time() - start), torch_device))
+
+    # Eight small genomes one after another and together on the same batches
+    smalls = [Genome(population).mutate_random(dict()) for _ in range(8)]
+    for together in [False, True]:
+        built = [build_net_from_genome(genome, [1, 28, 28], 10) for genome in smalls]
+        start = time.time()
+        if together:
+            train_together(smalls, *map(list, zip(*built)), [2] * len(smalls), torch_device=torch_device,
+                           data_loader_train=data_loader_train, save_net_param=False, save_gene_param=False)
+        else:
+            for genome, (net, optimizer, criterion) in zip(smalls, built):
+                train_on_data(genome, net, optimizer, criterion, epochs=2, torch_device=torch_device,
+                              data_loader_train=data_loader_train, save_net_param=False, save_gene_param=False)
+        if torch_device == 'cuda':
+            torch.cuda.synchronize()
+        print('8 small genomes - %-14s %7.1f steps/s on %s' %
+              ('together' if together else 'one by one',
+               2 * len(smalls) * len(data_loader_train) / (time.time() - start), torch_device))
+
+    # The large genome in every precision mode
+    for precision, channels_last in [('fp32', False), ('fp32', True), ('bf16', False), ('bf16', True), ('fp16', True)]:
+        net, optimizer, criterion = build_net_from_genome(large, [1, 28, 28], 10)
+        train_on_data(large, net, optimizer, criterion, epochs=1, torch_device=torch_device,
+                      data_loader_train=data_loader_train, save_net_param=False, save_gene_param=False,
+                      precision=precision, channels_last=channels_last)
+        print('large genome - %-4s channels_last=%-5s %7.1f samples/s on %s' %
+              (large.precision_stats['precision'], channels_last, large.precision_stats['samples_per_second'],
+               torch_device))
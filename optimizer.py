@@ -1,7 +1,7 @@
 import random
 import numpy as np
 
-from tools import weighted_choice, random_choices, limited_growth
+from tools import weighted_choice, random_choices, feature_dissimilarity
 
 
 class _Optimizer:
@@ -12,7 +12,7 @@ class _Optimizer:
     def __repr__(self):
         return super().__repr__()
 
-    def save(self):
+    def save(self, parameters=True):
         pass
 
     def load(self, save):
@@ -33,6 +33,11 @@ class SGDGene(_Optimizer):
     Stochastic gradient descent with nestrov momentum
     """
 
+    # How the hyperparameters of distance_features weigh in dissimilarity
+    distance_importance = np.array([0.55, 0.2, 0.25])
+    distance_relevance = np.array([5, 1, 3])
+    distance_categorical = np.array([False, False, False])
+
     def __init__(self, log_learning_rate=None, momentum=None, log_weight_decay=None):
         self.log_learning_rate = log_learning_rate if log_learning_rate is not None else self.init_log_learning_rate()
         self.momentum = momentum if momentum is not None else self.init_momentum()
@@ -43,7 +48,7 @@ class SGDGene(_Optimizer):
         return (r[:-1] + " | log_learning_rate=%.2f, mom=%.2f, log_weight_decay=%.2f" %
                 (self.log_learning_rate, self.momentum, self.log_weight_decay) + r[-1:])
 
-    def save(self):
+    def save(self, parameters=True):
         return [self.log_learning_rate, self.momentum, self.log_weight_decay]
 
     def load(self, save):
@@ -79,15 +84,14 @@ class SGDGene(_Optimizer):
         return SGDGene(log_learning_rate=self.log_learning_rate, momentum=self.momentum,
                        log_weight_decay=self.log_weight_decay)
 
+    def distance_features(self):
+        return [self.log_learning_rate, self.momentum, self.log_weight_decay]
+
     def dissimilarity(self, other):
         if type(other) != SGDGene:
             return 1
-
-        dist = np.array([self.log_learning_rate - other.log_learning_rate, self.momentum - other.momentum,
-                         self.log_weight_decay - other.log_weight_decay])
-        importance = np.array([0.55, 0.2, 0.25])
-        relevance = np.array([5, 1, 3])
-        return np.sum(limited_growth(np.abs(dist), importance, relevance))
+        return feature_dissimilarity(np.array(self.distance_features()), np.array(other.distance_features()),
+                                     self.distance_importance, self.distance_relevance, self.distance_categorical)
 
 
 class ADAMGene(_Optimizer):
@@ -95,6 +99,11 @@ class ADAMGene(_Optimizer):
     Adam algorithm for adaptive gradient descent
     """
 
+    # How the hyperparameters of distance_features weigh in dissimilarity
+    distance_importance = np.array([0.8, 0.2])
+    distance_relevance = np.array([5, 3])
+    distance_categorical = np.array([False, False])
+
     def __init__(self, log_learning_rate=None, log_weight_decay=None, parameters=None):
         self.log_learning_rate = log_learning_rate if log_learning_rate is not None else self.init_log_learning_rate()
         self.log_weight_decay = log_weight_decay if log_weight_decay is not None else self.init_log_weight_decay()
@@ -105,7 +114,10 @@ class ADAMGene(_Optimizer):
         return (r[:-1] + " | log_learning_rate=%.2f, log_weight_decay=%.2f" %
                 (self.log_learning_rate, self.log_weight_decay) + r[-1:])
 
-    def save(self):
+    def save(self, parameters=True):
+        # The state of torch's Adam only if parameters
+        if not parameters:
+            return [self.log_learning_rate, self.log_weight_decay]
         return [self.log_learning_rate, self.log_weight_decay, self.parameters]
 
     def load(self, save):
@@ -139,12 +151,11 @@ class ADAMGene(_Optimizer):
         return ADAMGene(log_learning_rate=self.log_learning_rate, log_weight_decay=self.log_weight_decay,
                         parameters=self.parameters.copy() if self.parameters is not None and copy_parameters else None)
 
+    def distance_features(self):
+        return [self.log_learning_rate, self.log_weight_decay]
+
     def dissimilarity(self, other):
         if type(other) != ADAMGene:
             return 1
-
-        dist = np.array([self.log_learning_rate - other.log_learning_rate,
-                         self.log_weight_decay - other.log_weight_decay])
-        importance = np.array([0.8, 0.2])
-        relevance = np.array([5, 3])
-        return np.sum(limited_growth(np.abs(dist), importance, relevance))
+        return feature_dissimilarity(np.array(self.distance_features()), np.array(other.distance_features()),
+                                     self.distance_importance, self.distance_relevance, self.distance_categorical)
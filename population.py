@@ -5,17 +5,24 @@ import pickle
 import math
 import random
 import logging
+import functools
+import multiprocessing
 import numpy as np
 from matplotlib.patches import Polygon
 from matplotlib.collections import PatchCollection
 
 import torch
 
-from KMedoids import KMedoids
+from KMedoids import fit_multi_k
 from genome import Genome
-from net import build_net_from_genome
+from net import build_net_from_genome, benchmark_latency, PRECISIONS
 from crossover import crossover
-from tools import score_decay, check_cuda_memory
+from distance import DistanceCache
+from checkpoint import ShardedCheckpoint, CheckpointWriter
+from results import ResultCache
+from curves import LearningCurves
+from profiler import Profiler, torch_profile
+from tools import cost_score, check_cuda_memory, MemoryTracker, seeded
 
 
 class Population:
@@ -24,7 +31,8 @@ class Population:
     -----
     n                - population size
     evaluate         - how to get a acc from genome
-    parent_selection - how parents are selected from the population
+    parent_selection - how parents are selected from the population, as couples of genomes or a (k, 2) array of
+                       indices into the sorted genomes of a species (see selection.py)
     crossover        - how to combine genomes to form new ones
     train            - how to train net nets
     epochs           - the standard (minimum) number of epochs to train before evaluation
@@ -39,17 +47,53 @@ class Population:
                        None:    don't save               parameters
     monitor          - if the results should be shown graphically
     load_params      - if the weights etc should be loaded when using load
+    n_workers        - number of processes that train genomes in parallel (1 trains in this process)
+    compile_nets     - if the nets run a static execution plan instead of interpreting the genome (see Net.compile)
+    leak_check       - count all tensors on cuda before/after training (slow, walks all python objects)
+    async_checkpoints - if checkpoints are written on a background thread (see CheckpointWriter), call flush at the end
+    keep_checkpoints - how many of the newest generations are kept in the checkpoints, None keeps all
+                       (see ShardedCheckpoint)
+    result_cache_size - how many trained genomes are remembered to reuse their results (see ResultCache)
+    max_params, max_flops, max_activation_memory - budgets for the estimated cost of a net (see Genome.estimate_cost)
+    over_budget      - repair: disable the most expensive genes of genomes over budget, reject: don't train them
+    scoring          - how to score a genome from acc, trained epochs, measurements, score_weights and score_targets
+    score_weights    - how much latency (seconds per batch), params and flops over score_targets lower the score
+    latency_batch_size - batch size of the latency benchmark, only run if latency has a weight
+    halving_rungs, halving_rate - successive halving, in how many steps genomes are trained and
+                       which fraction of every species is trained further after a step (see schedule_training)
+    curve_stopping   - stop training genomes whose learning curve predicts they won't be elites (see LearningCurves)
+    kmedoids_method  - alternate: assign and update medoids, fasterpam: swap medoids (see KMedoids)
+    train_group      - how to train several nets on the same batches (see train_together)
+    co_train         - how many genomes are trained together with train_group, 1 trains every genome alone
+    precision        - fp32, bf16 or fp16 (falls back to bf16 without cuda), given to train, train_group and evaluate
+                       as precision (see train_on_data)
+    channels_last    - if nets and images use the channels_last memory format, given like precision
+    precision_check  - also evaluate nets trained in reduced precision in fp32, saved in Genome.precision_stats
+    profile          - time the phases of every generation, appended to profile.jsonl/csv next to the checkpoints
+                       (see Profiler), profile_genome profiles the training of a single genome
     """
 
     def __init__(self, n, input_size, output_size, evaluate, parent_selection, train, cross_over=crossover,
                  name=None, elitism_rate=0.1, min_species_size=5, n_generations_no_change=5, tol=1e-5,
                  mutate_speed=1, min_species=1, max_species=10, epochs=2, reward_epochs=10,
-                 load=None, save_mode="elites", monitor=None, load_params=True):
+                 load=None, save_mode="elites", monitor=None, load_params=True, n_workers=1,
+                 compile_nets=False, leak_check=False, async_checkpoints=True, keep_checkpoints=None,
+                 result_cache_size=128, max_params=None, max_flops=None, max_activation_memory=None,
+                 over_budget='repair', scoring=cost_score, score_weights=None, score_targets=None,
+                 latency_batch_size=100, halving_rungs=1, halving_rate=3, curve_stopping=False,
+                 kmedoids_method='alternate', train_group=None, co_train=1, precision='fp32', channels_last=False,
+                 precision_check=False, profile=True):
         # Evolution parameters
         self.evaluate = evaluate
         self.parent_selection = parent_selection
         self.crossover = cross_over
         self.train = train
+        self.train_group = train_group
+        self.co_train = co_train
+        # Only given to train etc. if not the default, so they don't need to know about it
+        self.precision_kwargs = dict(precision=precision, channels_last=channels_last) \
+            if precision != 'fp32' or channels_last else dict()
+        self.precision_check = precision_check
         self.epochs = epochs
         self.reward_epochs = reward_epochs
         self.min_species_size = min_species_size
@@ -59,6 +103,19 @@ class Population:
         self.mutate_speed = mutate_speed
         self.n_generations_no_change = n_generations_no_change
         self.tol = tol
+        self.n_workers = n_workers
+        self.compile_nets = compile_nets
+        self.leak_check = leak_check
+        self.budget = {'params': max_params, 'flops': max_flops, 'activation_memory': max_activation_memory}
+        self.over_budget = over_budget
+        self.scoring = scoring
+        self.score_weights = {'latency': 0., 'params': 0., 'flops': 0., **(score_weights or dict())}
+        self.score_targets = {'latency': 1e-3, 'params': 1e5, 'flops': 1e6, **(score_targets or dict())}
+        self.latency_batch_size = latency_batch_size
+        self.halving_rungs = halving_rungs
+        self.halving_rate = halving_rate
+        self.curve_stopping = curve_stopping
+        self.kmedoids_method = kmedoids_method
 
         # Plotting and tracking training progress
         self.monitor = monitor
@@ -66,6 +123,16 @@ class Population:
 
         # Species centers calculated after first clustering
         self.species_repr = None
+        # Distances between genomes, kept over generations
+        self.distance_cache = DistanceCache()
+        self.checkpoints = ShardedCheckpoint(keep=keep_checkpoints)
+        self.checkpoint_writer = CheckpointWriter(self.checkpoints, background=async_checkpoints)
+        # Trained genomes, to not train the same genome twice
+        self.result_cache = ResultCache(result_cache_size)
+        # Learning curves of every species
+        self.curves = LearningCurves(elitism_rate=elitism_rate)
+        # Time spent in the phases of a generation
+        self.profiler = Profiler(enabled=profile)
         self.converged = False
 
         # What to save: save_genomes =1 saves elites =2 saves all genomes
@@ -95,6 +162,7 @@ class Population:
             self.generation = 1
             self.checkpoint_name = name or time.strftime("%d.%m-%H:%M")
 
+        self.profiler.directory = os.path.join(self.checkpoints.root, self.checkpoint_name)
         self.check_args()
 
     def check_args(self):
@@ -107,41 +175,60 @@ class Population:
         if self.min_species * self.min_species_size > self.n:
             raise ValueError("Can't achieve %d species with size %d.\n"
                              "Choose a higher n" % (self.min_species, self.min_species_size))
+        if self.n_workers < 1:
+            raise ValueError("n_workers (%d) has to be at least 1" % self.n_workers)
+        if self.halving_rungs < 1 or self.halving_rate <= 1:
+            raise ValueError("Successive halving needs at least 1 rung (%d) and a rate > 1 (%.2f)" %
+                             (self.halving_rungs, self.halving_rate))
+        if self.co_train < 1:
+            raise ValueError("co_train (%d) has to be at least 1" % self.co_train)
+        if self.co_train > 1 and self.train_group is None:
+            raise ValueError("Training %d genomes together needs train_group" % self.co_train)
+        if self.precision_kwargs.get('precision', 'fp32') not in PRECISIONS:
+            raise ValueError("Precision %s not supported" % self.precision_kwargs['precision'])
+        if self.over_budget not in ['repair', 'reject']:
+            raise ValueError("over_budget %s not supported" % self.over_budget)
 
     def next_id(self):
         return next(self.id_generator)
 
     def save_checkpoint(self, update=False):
+        """
+        Save the generation (see ShardedCheckpoint), with update after training
+        Only genomes whose parameters changed since the last save are written again
+        """
         if not update:
             # Remember the random state of the start or reproducibility
             self.this_gen_random_state = (random.getstate(), np.random.get_state(), torch.get_rng_state())
+        self.checkpoint_writer.save(self)
 
-        save = [self.n, self.id_generator, self.species_id_generator, self.generation,
-                self.input_size, self.output_size, self.checkpoint_name, self.top_acc, self.history,
-                self.this_gen_random_state,
-                (self.best_genome.__class__, self.best_genome.save()),
-                {species: [(genome.__class__, genome.save()) for genome in genomes]
-                 for species, genomes in self.species.items()}]
-
-        _dir = os.path.join('checkpoints', self.checkpoint_name)
-        if not os.path.exists(_dir):
-            os.makedirs(_dir)
-
-        with open(os.path.join(_dir, "%02d.cp" % self.generation), "wb") as c:
-            pickle.dump(save, c)
+    def flush(self):
+        """ Wait for all checkpoints to be written """
+        self.checkpoint_writer.flush()
+        for generation, stats in sorted(self.checkpoint_writer.stats.items()):
+            logging.info("Checkpoint I/O generation %02d: %.2f MB, %.3fs writing, %.3fs blocked" %
+                         (generation, stats['bytes'] / 2 ** 20, stats['seconds'], stats['blocked']))
 
     def load_checkpoint(self, checkpoint_name, generation, load_params=True):
+        if self.checkpoints.exists(checkpoint_name, generation):
+            saved_random_state = self.checkpoints.load(self, checkpoint_name, generation, load_params=load_params)
+        else:
+            saved_random_state = self.load_legacy_checkpoint(checkpoint_name, generation, load_params=load_params)
+        random.setstate(saved_random_state[0])
+        np.random.set_state(saved_random_state[1])
+        torch.set_rng_state(saved_random_state[2])
+
+    def load_legacy_checkpoint(self, checkpoint_name, generation, load_params=True):
+        """ Checkpoints that pickled the whole population in one file """
         file_path = os.path.join('checkpoints', checkpoint_name, "%02d.cp" % generation)
         with open(file_path, "rb") as c:
             [self.n, self.id_generator, self.species_id_generator, self.generation,
              self.input_size, self.output_size, self.checkpoint_name, self.top_acc, self.history,
              saved_random_state, saved_best_genome, saved_genomes] = pickle.load(c)
-            random.setstate(saved_random_state[0])
-            np.random.set_state(saved_random_state[1])
-            torch.set_rng_state(saved_random_state[2])
             self.best_genome = saved_best_genome[0](self).load(saved_best_genome[1], load_params=load_params)
             self.species = {species: [genome[0](self).load(genome[1], load_params=load_params) for genome in genomes]
                             for species, genomes in saved_genomes.items()}
+        return saved_random_state
 
     def cluster(self, threshold=120, rel_threshold=(1.2, 0.85)):
         """
@@ -166,10 +253,12 @@ class Population:
         all_genomes = [g for i in species_ids for g in self.species[i]]
 
         # Distance matrix, species sorted by id
-        distances = np.zeros((n, n))
-        for i in range(n):
-            for j in range(n):
-                distances[i, j] = all_genomes[i].dissimilarity(all_genomes[j])
+        hits, misses = self.distance_cache.hits, self.distance_cache.misses
+        with self.profiler.phase('distances'):
+            distances = self.distance_cache.update(all_genomes)
+            self.profiler.count('computed', self.distance_cache.misses - misses)
+        logging.info("Distance cache: %d hits, %d misses" %
+                     (self.distance_cache.hits - hits, self.distance_cache.misses - misses))
 
         # Get centers of old species, species sorted by size
         species_len = [len(self.species[sp]) for sp in species_ids]
@@ -185,9 +274,10 @@ class Population:
         low = max(self.min_species, k - 2)
         up = min(self.max_species, int(n / self.min_species_size), k + 2) + 1
         ids_to_check = list(range(low, up))
-        medoids = {i: KMedoids(n_clusters=i, metric='precomputed', min_cluster_size=self.min_species_size).
-                      fit(distances, old_centers=cur_centers)
-                   for i in ids_to_check}
+        with self.profiler.phase('kmedoids'):
+            medoids = fit_multi_k(distances, ids_to_check, old_centers=cur_centers, metric='precomputed',
+                                  min_cluster_size=self.min_species_size, method=self.kmedoids_method)
+            self.profiler.count('k', len(ids_to_check))
         all_labels = {i: medoid.labels_ for i, medoid in medoids.items()}
         scores = {i: medoid.score_ for i, medoid in medoids.items()}
 
@@ -226,8 +316,9 @@ class Population:
             self.history += [entry]
 
         if self.monitor is not None:
-            self.distance_plot(labels, distances)
-            self.species_plot()
+            with self.profiler.phase('monitor'):
+                self.distance_plot(labels, distances)
+                self.species_plot()
 
     def distance_plot(self, labels, distances):
         """
@@ -331,7 +422,8 @@ class Population:
                     # Decide who adopts them
                     while len(elite_genomes) > 0:
                         g, s = elite_genomes.pop(0)
-                        new_sp = min(species_ids, key=lambda sp: g.dissimilarity(self.species_repr[sp]))
+                        new_sp = min(species_ids,
+                                     key=lambda sp: self.distance_cache.distance(g, self.species_repr[sp]))
                         evaluated_genomes_by_species[new_sp] += [(g, s)]
 
                     # Delete genomes
@@ -376,6 +468,8 @@ class Population:
         evaluated_genomes_by_species = dict()
         score_by_species = dict()
         acc_by_species = dict()
+        # Accuracies in the order of the loop below, no matter how many processes train
+        accs = self.schedule_training(sorted(self.species.items()))
         for sp, genomes in sorted(self.species.items()):
             evaluated_genomes = []
             sp_scores = []
@@ -388,32 +482,33 @@ class Population:
 
                 # Visualize current net
                 if self.monitor is not None:
-                    self.monitor.plot(1, (g.__class__, g.save(parameters=False)), kind='net-plot', title='train',
-                                      n=self.n, i=i, input_size=self.input_size, clear=True, show=True)
-
-                logging.debug('Building Net')
-                try:
-                    net, optim, criterion = build_net_from_genome(g, self.input_size, self.output_size)
-                    logging.info("Cuda Usage %d - before training" % len(check_cuda_memory()))
-                    self.train(g, net, optim, criterion, epochs=self.epochs + g.reward,
-                               save_net_param=self.save_genomes >= 1, save_gene_param=self.save_genes)
-                    g.reward = 0
-                    logging.info("Cuda Usage %d - after training" % len(check_cuda_memory()))
-                    acc = self.evaluate(net)
-                    logging.info("Cuda Usage %d - after evaluation" % len(check_cuda_memory()))
-                except RuntimeError as e:
-                    logging.info("Net failed to train:\n%s" % e)
-                    acc = 0
+                    with self.profiler.phase('monitor'):
+                        self.monitor.plot(1, (g.__class__, g.save(parameters=False)), kind='net-plot', title='train',
+                                          n=self.n, i=i, input_size=self.input_size, clear=True, show=True)
+
+                # Genomes are trained when their acc is needed
+                with self.profiler.phase('train'):
+                    acc = next(accs)
                 g.acc = acc
-                score = score_decay(acc, g.trained)
+                if g.predicted is None:
+                    self.curves.add(sp, g.curve, acc, g.curve_offset)
+                g.history += [{'generation': self.generation, 'acc': acc, 'trained': g.trained, 'memory': g.memory,
+                               'inherited': g.inherited, 'cost': g.cost, 'latency': g.latency,
+                               'precision': g.precision_stats}]
+                logging.info("Estimated cost: %s" % g.cost)
+                logging.info("Peak memory: %s" % g.memory)
+                measurements = {'latency': g.latency, 'params': g.cost['params'], 'flops': g.cost['flops']}
+                score = self.scoring(acc, max(g.trained, g.trained_budget or 0), measurements, self.score_weights,
+                                     self.score_targets)
 
                 # Show best net
                 if acc > self.top_acc:
                     self.top_acc = acc
                     self.best_genome = g.copy()
                     if self.monitor is not None:
-                        self.monitor.plot(0, (g.__class__, g.save(parameters=False)), kind='net-plot', title='best',
-                                          input_size=(1, 28, 28), acc=acc, clear=True, show=True)
+                        with self.profiler.phase('monitor'):
+                            self.monitor.plot(0, (g.__class__, g.save(parameters=False)), kind='net-plot',
+                                              title='best', input_size=(1, 28, 28), acc=acc, clear=True, show=True)
 
                 evaluated_genomes += [(g, score)]
                 sp_scores += [score]
@@ -429,13 +524,253 @@ class Population:
 
             # Fill species plot
             if self.monitor is not None:
-                p = PatchCollection([self.polygons[sp]], cmap='viridis', alpha=0.4)
-                colors = [score_by_species[sp]**3]
-                p.set_array(np.array(colors))
-                p.set_clim([0, 1])
-                self.monitor.plot(2, p, kind='add_collection')
+                with self.profiler.phase('monitor'):
+                    p = PatchCollection([self.polygons[sp]], cmap='viridis', alpha=0.4)
+                    colors = [score_by_species[sp]**3]
+                    p.set_array(np.array(colors))
+                    p.set_clim([0, 1])
+                    self.monitor.plot(2, p, kind='add_collection')
+
+        logging.info("Result cache: %d hits, %d misses" % (self.result_cache.hits, self.result_cache.misses))
+        self.profiler.count('result_cache_hits', self.result_cache.hits)
+        self.result_cache.reset_stats()
         return [evaluated_genomes_by_species, score_by_species, acc_by_species]
 
+    def schedule_training(self, species):
+        """
+        Train and evaluate the genomes of all species [(species, genomes)], yielding their accuracies in order
+        Every genome has a budget of epochs + reward epochs. With successive halving (halving_rungs > 1) all genomes
+        are trained for a part of their budget, only the best 1/halving_rate of every species are trained further,
+        in the last rung to their full budget. The others keep the acc of their last rung and, unless
+        save_mode keeps the nets of all genomes, lose their net and optimizer state.
+        Genomes are scored as if trained for their full budget (Genome.trained_budget), so genomes dropped by
+        successive halving or stopped early don't get a smaller score decay than fully trained ones.
+        """
+        genomes = [g for sp, sp_genomes in species for g in sp_genomes]
+        budgets = [self.epochs + g.reward for g in genomes]
+        for g, budget in zip(genomes, budgets):
+            g.trained_budget = g.trained + budget
+        # The curves from before this generation, the same for every genome whether it is trained here or in
+        # a worker process (which only gets a pickled copy)
+        curves = self.curves.snapshot()
+        # Losses are extrapolated to the end of the full budget, not of a rung
+        predictors = [functools.partial(curves.stop, sp, g.trained_budget) if self.curve_stopping else None
+                      for sp, sp_genomes in species for g in sp_genomes]
+        if self.halving_rungs == 1:
+            yield from self.train_genomes(genomes, budgets, predictors)
+            return
+
+        accs = [0] * len(genomes)
+        done = [0] * len(genomes)
+        promoted = list(range(len(genomes)))
+        seconds, epochs = 0, 0
+        for rung in range(self.halving_rungs):
+            last = rung == self.halving_rungs - 1
+            targets = {i: budgets[i] if last else
+                       max(1, math.ceil(budgets[i] * self.halving_rate ** (rung + 1 - self.halving_rungs)))
+                       for i in promoted}
+            train = [i for i in promoted if targets[i] > done[i]]
+            start = time.time()
+            # Keep the nets of all genomes that may be trained further
+            for i, acc in zip(train, self.train_genomes([genomes[i] for i in train],
+                                                        [targets[i] - done[i] for i in train],
+                                                        [predictors[i] for i in train],
+                                                        save_net_param=True if not last else None)):
+                accs[i] = acc
+            seconds += time.time() - start
+            epochs += sum(targets[i] - done[i] for i in train)
+            for i in train:
+                done[i] = targets[i]
+            if last:
+                break
+
+            # Promote the best of every species
+            promoted, offset = [], 0
+            for sp, sp_genomes in species:
+                candidates = [i for i in range(offset, offset + len(sp_genomes)) if i in targets]
+                candidates = sorted(candidates, key=lambda i: accs[i], reverse=True)
+                promoted += candidates[:math.ceil(len(candidates) / self.halving_rate)]
+                offset += len(sp_genomes)
+            logging.info("Successive halving: %d of %d genomes promoted after rung %d" %
+                         (len(promoted), len(targets), rung + 1))
+            # Intermediate rungs always keep the nets, only save_mode decides for the dropped genomes
+            if self.save_genomes < 1:
+                for i in set(targets) - set(promoted):
+                    self.drop_parameters(genomes[i])
+
+        # The last rung didn't save the nets, the ones of the rungs before are outdated
+        if self.save_genomes < 1:
+            for i in promoted:
+                self.drop_parameters(genomes[i])
+
+        # Estimated by the mean time of an epoch
+        saved = sum(budgets) - sum(done)
+        logging.info("Successive halving: %d of %d epochs trained, about %.1fs saved" %
+                     (sum(done), sum(budgets), saved * seconds / max(1, epochs)))
+        yield from accs
+
+    @staticmethod
+    def drop_parameters(g):
+        """ Forget the trained net and optimizer state of a genome """
+        g.net_parameters = None
+        if hasattr(g.optimizer, 'parameters'):
+            g.optimizer.parameters = None
+
+    def train_genomes(self, genomes, epochs, predictors, save_net_param=None):
+        """
+        Train and evaluate the genomes for epochs (one per genome), yielding their accuracies in the given order
+        predictors (one per genome or None) can stop the training, see train_on_data
+        Genomes with a result in the ResultCache (or the same as one before in genomes) are not trained again
+        Genomes over budget (see enforce_budget) get an acc of 0 without being built
+        save_net_param - overrides if the trained nets are saved in the genomes
+        """
+        keys = [self.result_cache.key(g, e) if self.enforce_budget(g) else None for g, e in zip(genomes, epochs)]
+        # Look up before training so only the rest is send to the workers
+        cached = []
+        first = dict()
+        for g, e, predictor, key in zip(genomes, epochs, predictors, keys):
+            if key is None:
+                cached += [None]
+            elif key in first:
+                # The same as a genome trained before in genomes
+                self.result_cache.hits += 1
+                cached += [None]
+            else:
+                cached += [self.result_cache.get(key)]
+                if cached[-1] is None:
+                    first[key] = g, e, predictor
+        trained = self.train_uncached([g for g, _, _ in first.values()], [e for _, e, _ in first.values()],
+                                      [predictor for _, _, predictor in first.values()],
+                                      save_net_param=save_net_param)
+
+        batch = dict()
+        for g, key, result in zip(genomes, keys, cached):
+            if key is None:
+                yield 0
+            elif result is None and first[key][0] is g:
+                batch[key] = self.result_cache.result(g, next(trained))
+                # Stopped genomes only have a predicted acc
+                if g.predicted is None:
+                    self.result_cache.put(key, batch[key])
+                yield batch[key]['acc']
+            else:
+                yield self.result_cache.apply(g, result or batch[key])
+
+    def enforce_budget(self, g):
+        """
+        Estimate the cost of a genome (see Genome.estimate_cost) and check it against the budgets
+        Over budget genomes are rejected or repaired by disabling their most expensive genes in the metrics over
+        budget, as long as the output stays reachable. Returns whether the genome can be trained
+        """
+        cost = g.estimate_cost(self.input_size, self.output_size)
+        over = [k for k, limit in self.budget.items() if limit is not None and cost[k] > limit]
+        while len(over) > 0:
+            if self.over_budget == 'reject':
+                logging.info("Genome over budget (%s), rejected: %s" % (', '.join(over), cost))
+                return False
+            # Most expensive by their share of the limits that are exceeded, sorted again after every disabled gene
+            genes = sorted([gene for gene in g.genes if gene.enabled and g.nodes_by_id[gene.id_in].size is not None],
+                           key=lambda gene: self.budget_share(gene.cost(g.nodes_by_id[gene.id_in].size), over),
+                           reverse=True)
+            for gene in genes:
+                g.set_enabled(gene, False)
+                if g.dfs(0, 2):
+                    break
+                g.set_enabled(gene, True)
+            else:
+                logging.info("Genome over budget (%s), can't be repaired: %s" % (', '.join(over), cost))
+                return False
+            # The saved net doesn't fit anymore
+            g.net_parameters = None
+            logging.info("Genome over budget (%s), disabled gene %d" % (', '.join(over), gene.id))
+            cost = g.estimate_cost(self.input_size, self.output_size)
+            over = [k for k, limit in self.budget.items() if limit is not None and cost[k] > limit]
+        return True
+
+    def budget_share(self, gene_cost, over):
+        """ The sum of the shares a gene's cost (see Gene.cost) has of the budgets in over """
+        # Gene.cost counts activations, activation_memory is in bytes of float32
+        components = {'params': gene_cost[0], 'flops': gene_cost[1], 'activation_memory': 4 * gene_cost[2]}
+        return sum(components[k] / max(1, self.budget[k]) for k in over)
+
+    def train_uncached(self, genomes, epochs, predictors, save_net_param=None):
+        """
+        Train and evaluate the genomes for epochs, yielding their accuracies in the given order
+        With co_train > 1 groups of co_train genomes share the batches of one data pass (see train_genome_group)
+
+        Every group is trained with its own seed (see tools.seeded) drawn in this process before training,
+        so the results are the same whichever process trains a group and the random numbers of this process
+        don't depend on training.
+
+        With n_workers > 1 the groups are send to a pool of processes (see train_worker) and
+        the results are merged back into the genomes in order. The workers are started by a fork server
+        (spawned where there is none), forking this process after torch started its threads can hang them.
+        train/evaluate and with them the data loaders are pickled once for every worker.
+        """
+        args = [self.input_size, self.output_size, self.train, self.evaluate,
+                dict(compiled=self.compile_nets),
+                dict(save_net_param=self.save_genomes >= 1 if save_net_param is None else save_net_param,
+                     save_gene_param=self.save_genes), self.leak_check,
+                self.latency_batch_size if self.score_weights['latency'] > 0 else None, self.train_group,
+                self.precision_kwargs, self.precision_check]
+        groups = [list(range(i, min(i + self.co_train, len(genomes)))) for i in range(0, len(genomes), self.co_train)]
+        base_seed = np.random.randint(2 ** 31)
+        seeds = [int(np.random.SeedSequence([base_seed, self.generation, i]).generate_state(1)[0])
+                 for i in range(len(groups))]
+        if self.n_workers == 1:
+            for group, seed in zip(groups, seeds):
+                gs = [genomes[i] for i in group]
+                with seeded(seed):
+                    accs = train_genome_group(gs, [epochs[i] for i in group], *args,
+                                              predictors=[predictors[i] for i in group])
+                for g, acc in zip(gs, accs):
+                    self.count_training(g)
+                    yield acc
+            return
+
+        payloads = [[(genomes[i].__class__, genomes[i].save(),
+                      {gene.id: gene.net_parameters for gene in genomes[i].genes}, epochs[i], predictors[i])
+                     for i in group] for group in groups]
+        start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        context = multiprocessing.get_context(start_method)
+        with context.Pool(min(self.n_workers, len(groups)), initializer=init_worker,
+                          initargs=(args, self.n_workers)) as pool:
+            for group, results in zip(groups, pool.imap(train_worker, zip(seeds, payloads))):
+                for i, (acc, saved, gene_parameters, stats) in zip(group, results):
+                    g = genomes[i]
+                    g.load(saved)
+                    for k, v in stats.items():
+                        setattr(g, k, v)
+                    for gene in g.genes:
+                        gene.net_parameters = gene_parameters[gene.id]
+                    self.count_training(g)
+                    yield acc
+
+    def count_training(self, g):
+        """ Add a trained genome to the profile, its samples and where its time went (see train_genome) """
+        self.profiler.count('genomes')
+        self.profiler.count('samples', (g.precision_stats or dict()).get('samples', 0))
+        for k, seconds in (g.timings or dict()).items():
+            self.profiler.count('%s_seconds' % k, seconds)
+
+    def profile_genome(self, g, epochs=None, path=None):
+        """
+        Train and evaluate a copy of a genome (e.g. the best one) in this process under torch.profiler,
+        the trace and a table of the slowest ops are saved to path (next to the checkpoints by default),
+        returns the acc and the torch profiler
+        """
+        g = g.copy()
+        path = path or os.path.join(self.profiler.directory, 'genome_%02d_%s' % (self.generation,
+                                                                                g.structural_hash()[:8]))
+        args = [self.input_size, self.output_size, self.train, self.evaluate, dict(compiled=self.compile_nets),
+                dict(save_net_param=False, save_gene_param=False), False,
+                self.latency_batch_size if self.score_weights['latency'] > 0 else None, self.train_group,
+                self.precision_kwargs, self.precision_check]
+        with torch_profile(path) as profiler:
+            acc = train_genome(g, self.epochs if epochs is None else epochs, *args)
+        logging.info("Profiled genome, acc %.4f, trace saved to %s.json" % (acc, path))
+        return acc, profiler
+
     def rewards(self, evaluated_genomes_by_species, score_by_species):
         """
         The best performing nets get extra time to train so that faster progress can be made
@@ -458,19 +793,25 @@ class Population:
         """
         # Saving checkpoint
         print("Saving checkpoint\n")
-        self.save_checkpoint()
+        with self.profiler.phase('save_checkpoint'):
+            self.save_checkpoint()
 
         # show best net
         if self.monitor is not None:
-            self.monitor.plot(0, (self.best_genome.__class__, self.best_genome.save(parameters=False)), kind='net-plot',
-                              input_size=self.input_size, acc=self.top_acc, title='best', clear=True, show=True)
+            with self.profiler.phase('monitor'):
+                self.monitor.plot(0, (self.best_genome.__class__, self.best_genome.save(parameters=False)),
+                                  kind='net-plot', input_size=self.input_size, acc=self.top_acc, title='best',
+                                  clear=True, show=True)
 
-        self.cluster()
-        evaluated_genomes_by_species, score_by_species, acc_by_species = self.train_nets()
+        with self.profiler.phase('cluster'):
+            self.cluster()
+        with self.profiler.phase('train_nets'):
+            evaluated_genomes_by_species, score_by_species, acc_by_species = self.train_nets()
 
         # Saving checkpoint with net parameters
         print("Saving checkpoint after training\n")
-        self.save_checkpoint(update=True)
+        with self.profiler.phase('save_checkpoint'):
+            self.save_checkpoint(update=True)
 
         print('\n\nGENERATION %d\n' % self.generation)
         for species, evaluated_genomes in evaluated_genomes_by_species.items():
@@ -484,10 +825,11 @@ class Population:
             print()
 
         # Resize species, increase better scoring species and kill bad performing ones
-        score_by_species = self.species_death(evaluated_genomes_by_species, score_by_species)
-        new_sizes = self.new_species_sizes(score_by_species)
+        with self.profiler.phase('species_death'):
+            score_by_species = self.species_death(evaluated_genomes_by_species, score_by_species)
+            new_sizes = self.new_species_sizes(score_by_species)
 
-        self.rewards(evaluated_genomes_by_species, score_by_species)
+            self.rewards(evaluated_genomes_by_species, score_by_species)
 
         print("Breading new neural networks")
         # Same mutations (split_edge) in a gen get the same innovation number
@@ -510,9 +852,15 @@ class Population:
                     g.net_parameters = None
 
             # Selection & Crossover & Mutation
-            parents = self.parent_selection(evaluated_genomes, k=new_n_sp-elitism)
-            new_genomes = [self.crossover(p[0], p[1]).mutate_random(this_gen_mutations, exception=self.mutate_speed)
-                           for p in parents]
+            with self.profiler.phase('selection'):
+                parents = self.parent_selection(evaluated_genomes, k=new_n_sp-elitism)
+                if isinstance(parents, np.ndarray):
+                    parents = [[evaluated_genomes[i][0], evaluated_genomes[j][0]] for i, j in parents]
+            with self.profiler.phase('crossover'):
+                new_genomes = [self.crossover(p[0], p[1]).mutate_random(this_gen_mutations,
+                                                                        exception=self.mutate_speed)
+                               for p in parents]
+                self.profiler.count('children', len(new_genomes))
             self.species[sp] = elite_genomes + new_genomes
 
         x = len([g for sp, genomes in self.species.items() for g in genomes])
@@ -521,4 +869,171 @@ class Population:
             print()
             logging.error("Error occured in evolution step")
 
+        self.profiler.end(self.generation)
         self.generation += 1
+
+
+def train_genome(g, epochs, input_size, output_size, train, evaluate, net_kwargs, train_kwargs, leak_check=False,
+                 latency_batch_size=None, train_group=None, precision_kwargs=None, precision_check=False,
+                 predictor=None):
+    """
+    Build, train and evaluate the net of a genome, returns the accuracy
+    Nets that fail to train (e.g. out of memory) get an accuracy of 0
+    The peak memory and, if latency_batch_size is given, the inference latency are saved in the genome
+    Genomes stopped by the predictor (see train_on_data) aren't evaluated, their acc is the predicted one
+    """
+    logging.debug('Building Net')
+    precision_kwargs = precision_kwargs or dict()
+    memory = MemoryTracker().start()
+    g.latency = None
+    g.timings = dict()
+    try:
+        start = time.perf_counter()
+        net, optim, criterion = build_net_from_genome(g, input_size, output_size, **net_kwargs)
+        g.timings['build'] = time.perf_counter() - start
+        if leak_check:
+            logging.info("Cuda Usage %d - before training" % len(check_cuda_memory()))
+        g.curve, g.curve_offset, g.predicted, g.precision_stats = [], 0, None, None
+        start = time.perf_counter()
+        if predictor is not None:
+            train(g, net, optim, criterion, epochs=epochs, predictor=predictor, **train_kwargs, **precision_kwargs)
+        else:
+            train(g, net, optim, criterion, epochs=epochs, **train_kwargs, **precision_kwargs)
+        g.timings['train'] = time.perf_counter() - start
+        g.reward = 0
+        memory.sample()
+        if leak_check:
+            logging.info("Cuda Usage %d - after training" % len(check_cuda_memory()))
+        start = time.perf_counter()
+        acc = evaluate_genome(g, net, input_size, evaluate, latency_batch_size, precision_kwargs, precision_check)
+        g.timings['evaluate'] = time.perf_counter() - start
+        if leak_check:
+            logging.info("Cuda Usage %d - after evaluation" % len(check_cuda_memory()))
+    except RuntimeError as e:
+        logging.info("Net failed to train:\n%s" % e)
+        acc = 0
+    g.memory = memory.stop()
+    return acc
+
+
+def train_genome_group(gs, epochs, input_size, output_size, train, evaluate, net_kwargs, train_kwargs,
+                       leak_check=False, latency_batch_size=None, train_group=None, precision_kwargs=None,
+                       precision_check=False, predictors=None):
+    """
+    Build the nets of several genomes, train them together with train_group and evaluate them,
+    returns their accuracies (see train_genome)
+    A single genome, or a group that fails to train together (e.g. out of memory), is trained one by one
+    The peak memory saved in the genomes is the one of the whole group
+    """
+    predictors = predictors or [None] * len(gs)
+    if len(gs) == 1:
+        return [train_genome(gs[0], epochs[0], input_size, output_size, train, evaluate, net_kwargs, train_kwargs,
+                             leak_check, latency_batch_size, train_group, precision_kwargs, precision_check,
+                             predictor=predictors[0])]
+    logging.debug('Building %d Nets' % len(gs))
+    precision_kwargs = precision_kwargs or dict()
+    memory = MemoryTracker().start()
+    # Everything training together changes, to fall back to training one by one from the start
+    before = [(g.trained, g.loss, g.no_change, g.net_parameters, getattr(g.optimizer, 'parameters', None),
+               {gene.id: dict(gene.net_parameters) for gene in g.genes}) for g in gs]
+    try:
+        built = []
+        for g in gs:
+            start = time.perf_counter()
+            built += [build_net_from_genome(g, input_size, output_size, **net_kwargs)]
+            g.latency = None
+            g.curve, g.curve_offset, g.predicted, g.precision_stats = [], 0, None, None
+            g.timings = {'build': time.perf_counter() - start}
+        start = time.perf_counter()
+        train_group(gs, [net for net, _, _ in built], [optim for _, optim, _ in built],
+                    [criterion for _, _, criterion in built], epochs, predictors=predictors, **train_kwargs,
+                    **precision_kwargs)
+    except RuntimeError as e:
+        logging.info("Nets failed to train together, training them one by one:\n%s" % e)
+        memory.stop()
+        # Undo the epochs trained together
+        for g, (trained, loss, no_change, net_parameters, optimizer_parameters, gene_parameters) in zip(gs, before):
+            g.trained, g.loss, g.no_change, g.net_parameters = trained, loss, no_change, net_parameters
+            if hasattr(g.optimizer, 'parameters'):
+                g.optimizer.parameters = optimizer_parameters
+            for gene in g.genes:
+                gene.net_parameters = gene_parameters[gene.id]
+        return [train_genome(g, g_epochs, input_size, output_size, train, evaluate, net_kwargs, train_kwargs,
+                             leak_check, latency_batch_size, train_group, precision_kwargs, precision_check,
+                             predictor=predictor)
+                for g, g_epochs, predictor in zip(gs, epochs, predictors)]
+    # Every genome gets an equal share of the time trained together
+    for g in gs:
+        g.timings['train'] = (time.perf_counter() - start) / len(gs)
+    memory.sample()
+    # Nets that fail to evaluate get an accuracy of 0 like in train_genome, they are already trained
+    accs = []
+    for g, (net, _, _) in zip(gs, built):
+        g.reward = 0
+        start = time.perf_counter()
+        try:
+            accs += [evaluate_genome(g, net, input_size, evaluate, latency_batch_size, precision_kwargs,
+                                     precision_check)]
+        except RuntimeError as e:
+            logging.info("Net failed to evaluate:\n%s" % e)
+            accs += [0]
+        g.timings['evaluate'] = time.perf_counter() - start
+    peak = memory.stop()
+    for g in gs:
+        g.memory = peak
+    return accs
+
+
+def evaluate_genome(g, net, input_size, evaluate, latency_batch_size=None, precision_kwargs=None,
+                    precision_check=False):
+    """
+    The accuracy of a trained net, the predicted one if it was stopped (see train_on_data)
+    The accuracy is added to g.precision_stats, with precision_check also the one in fp32.
+    If latency_batch_size is given, the inference latency is saved in the genome
+    """
+    precision_kwargs = precision_kwargs or dict()
+    acc = g.predicted
+    if acc is None:
+        # The net stays on the device for the fp32 check and the latency and is moved back once at the end
+        acc = evaluate(net, move_back=False, **precision_kwargs).accuracy
+        if g.precision_stats is not None:
+            g.precision_stats['acc'] = acc
+            if precision_check and len(precision_kwargs) > 0:
+                g.precision_stats['fp32_acc'] = evaluate(net, move_back=False).accuracy
+    # Latency on the device the net was trained on
+    if latency_batch_size is not None:
+        g.latency = benchmark_latency(net, input_size, batch_size=latency_batch_size, **precision_kwargs)
+    net.to('cpu')
+    return acc
+
+
+# Set in every worker process of Population.train_genomes
+_worker_args = None
+
+
+def init_worker(args, n_workers):
+    """ Remember what every genome is trained with (see train_genome) and share the cores between the workers """
+    global _worker_args
+    _worker_args = args
+    torch.set_num_threads(max(1, multiprocessing.cpu_count() // n_workers))
+
+
+def train_worker(task):
+    """
+    Train a group of genomes saved with Genome.save in a worker process (see train_genome_group)
+    task is the seed of the group (see Population.train_uncached) and the payloads of its genomes
+    Returns for every genome the accuracy, the saved trained genome, the weights saved in its genes
+    and its training_stats
+    """
+    seed, payloads = task
+    gs = []
+    for genome_class, saved, gene_parameters, _, _ in payloads:
+        g = genome_class(None).load(saved)
+        for gene in g.genes:
+            gene.net_parameters = gene_parameters[gene.id]
+        gs += [g]
+    with seeded(seed):
+        accs = train_genome_group(gs, [payload[3] for payload in payloads], *_worker_args,
+                                  predictors=[payload[4] for payload in payloads])
+    return [(acc, g.save(), {gene.id: gene.net_parameters for gene in g.genes},
+             {k: getattr(g, k) for k in g.training_stats}) for acc, g in zip(accs, gs)]
@@ -0,0 +1,119 @@
+import os
+import csv
+import json
+import time
+import logging
+import contextlib
+
+import torch
+
+from tools import process_rss
+
+
+class Profiler:
+    """
+    Wall time, cpu time, samples/s and memory of the phases of a generation
+    -----
+    with profiler.phase('cluster'):   - times a phase, a phase inside another is named 'outer/inner'.
+                                        Entering a phase again in the same generation adds to it
+    profiler.count('samples', n)      - adds to a counter of the innermost phase (samples give samples/s)
+                                        or of the generation outside of all phases
+    profiler.end(generation)          - appends the generation to <directory>/profile.jsonl and profile.csv,
+                                        with the wall and cpu time since the last end
+
+    Memory is the RSS of the process at the end of a phase and how much it changed in the phase
+    """
+
+    columns = ['generation', 'phase', 'calls', 'wall_seconds', 'cpu_seconds', 'samples', 'samples_per_second',
+               'rss', 'rss_change']
+
+    def __init__(self, directory=None, enabled=True):
+        self.directory = directory
+        self.enabled = enabled
+        self.stack = []
+        self.phases = dict()
+        self.counters = dict()
+        self.start = time.perf_counter(), time.process_time()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        self.stack += [name]
+        key = '/'.join(self.stack)
+        stats = self.phases.setdefault(key, {'calls': 0, 'wall_seconds': 0., 'cpu_seconds': 0., 'samples': 0,
+                                             'rss': None, 'rss_change': 0})
+        rss = process_rss()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            stats['wall_seconds'] += time.perf_counter() - wall
+            stats['cpu_seconds'] += time.process_time() - cpu
+            stats['calls'] += 1
+            stats['rss'] = process_rss()
+            if rss is not None and stats['rss'] is not None:
+                stats['rss_change'] += stats['rss'] - rss
+            self.stack.pop()
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        counters = self.phases['/'.join(self.stack)] if len(self.stack) > 0 else self.counters
+        counters[name] = counters.get(name, 0) + value
+
+    def end(self, generation):
+        """ Write and log the profile of the generation and start the next one, returns the profile """
+        if not self.enabled:
+            return None
+        for stats in self.phases.values():
+            stats['samples_per_second'] = stats['samples'] / stats['wall_seconds'] \
+                if stats['samples'] > 0 and stats['wall_seconds'] > 0 else None
+        profile = {'generation': generation, 'wall_seconds': time.perf_counter() - self.start[0],
+                   'cpu_seconds': time.process_time() - self.start[1], 'phases': self.phases,
+                   'counters': self.counters}
+        logging.info("Profile generation %02d %-32s %8.3fs wall %8.3fs cpu" %
+                     (generation, 'total', profile['wall_seconds'], profile['cpu_seconds']))
+        for name, stats in self.phases.items():
+            logging.info("Profile generation %02d %-32s %8.3fs wall %8.3fs cpu (%d calls)" %
+                         (generation, name, stats['wall_seconds'], stats['cpu_seconds'], stats['calls']))
+        if self.directory is not None:
+            self.write(profile)
+        self.phases, self.counters = dict(), dict()
+        self.start = time.perf_counter(), time.process_time()
+        return profile
+
+    def write(self, profile):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        with open(os.path.join(self.directory, 'profile.jsonl'), 'a') as f:
+            f.write(json.dumps(profile) + '\n')
+        path = os.path.join(self.directory, 'profile.csv')
+        new = not os.path.exists(path)
+        with open(path, 'a', newline='') as f:
+            writer = csv.writer(f)
+            if new:
+                writer.writerow(self.columns)
+            for name, stats in profile['phases'].items():
+                writer.writerow([profile['generation'], name] + [stats[k] for k in self.columns[2:]])
+
+
+@contextlib.contextmanager
+def torch_profile(path, torch_device='cpu', row_limit=20):
+    """
+    Run torch.profiler around the block, save a chrome trace (<path>.json, open in chrome://tracing or perfetto)
+    and the ops that took the longest (<path>.txt)
+    """
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.device(torch_device).type == 'cuda':
+        activities += [torch.profiler.ProfilerActivity.CUDA]
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True) as profiler:
+        yield profiler
+    profiler.export_chrome_trace(path + '.json')
+    sort_by = 'cuda_time_total' if torch.profiler.ProfilerActivity.CUDA in activities else 'cpu_time_total'
+    with open(path + '.txt', 'w') as f:
+        f.write(profiler.key_averages().table(sort_by=sort_by, row_limit=row_limit))
@@ -0,0 +1,64 @@
+import collections
+
+
+class ResultCache:
+    """
+    Trained genomes by (Genome.structural_hash, training budget), a least recently used cache of size max_size
+    The budget is the number of epochs a genome has been trained after training, so a genome that is structurally
+    the same as one trained before (e.g. a child without mutations) reuses its acc, loss and parameters.
+    hits/misses count the lookups since the last reset
+    """
+
+    def __init__(self, max_size=128):
+        if max_size < 0:
+            raise ValueError('max_size should be nonnegative, %d was given' % max_size)
+        self.max_size = max_size
+        self.results = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(genome, epochs):
+        return genome.structural_hash(), genome.trained + epochs
+
+    def get(self, key):
+        """ The result of key or None, counted as hit/miss """
+        result = self.results.get(key)
+        if result is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.results.move_to_end(key)
+        return result
+
+    def put(self, key, result):
+        self.results[key] = result
+        self.results.move_to_end(key)
+        while len(self.results) > self.max_size:
+            self.results.popitem(last=False)
+
+    def reset_stats(self):
+        self.hits, self.misses = 0, 0
+
+    @staticmethod
+    def result(genome, acc):
+        """ What training changed in a genome """
+        return {'acc': acc, 'loss': genome.loss, 'trained': genome.trained, 'no_change': genome.no_change,
+                'net_parameters': genome.net_parameters,
+                'optimizer_parameters': getattr(genome.optimizer, 'parameters', None),
+                'gene_parameters': {gene.id: dict(gene.net_parameters) for gene in genome.genes},
+                'stats': {k: getattr(genome, k) for k in genome.training_stats}}
+
+    @staticmethod
+    def apply(genome, result):
+        """ Set a result in a genome as if it was trained, returns the acc """
+        genome.loss, genome.trained, genome.no_change = result['loss'], result['trained'], result['no_change']
+        genome.net_parameters = result['net_parameters']
+        if hasattr(genome.optimizer, 'parameters'):
+            genome.optimizer.parameters = result['optimizer_parameters']
+        for gene in genome.genes:
+            gene.net_parameters = dict(result['gene_parameters'].get(gene.id, gene.net_parameters))
+        for k, v in result['stats'].items():
+            setattr(genome, k, v)
+        genome.reward = 0
+        return result['acc']
@@ -1,10 +1,61 @@
 import numpy as np
-import random
 import math
 
 
 # These selections all assume evaluated_genomes to be a sorted list of genomes
-# where the first in the list is the fittest
+# where the first in the list is the fittest.
+# All couples are drawn at once, they are returned as a (k, 2) array of indices into evaluated_genomes
+# with the more fit parent first (see Population.evolve)
+
+def random_pairs(m, k):
+    """ k pairs of two different indices in range(m), both orders equally likely """
+    first = np.random.randint(m, size=k)
+    second = np.random.randint(m - 1, size=k)
+    second += second >= first
+    return np.stack([first, second], axis=1)
+
+
+def random_subsets(n, size, k):
+    """ k uniformly random subsets of range(n) with <size> elements each (Floyd's algorithm), in random order """
+    subsets = np.empty((k, size), dtype=int)
+    for i, j in enumerate(range(n - size, n)):
+        r = np.random.randint(j + 1, size=k)
+        taken = np.any(subsets[:, :i] == r[:, None], axis=1)
+        subsets[:, i] = np.where(taken, j, r)
+    return np.take_along_axis(subsets, np.argsort(np.random.rand(k, size), axis=1), axis=1)
+
+
+def weighted_pairs(weights, k):
+    """
+    k pairs drawn like np.random.choice(n, size=2, p=weights/sum(weights), replace=False):
+    the first by its weight, the second by its weight among the rest.
+    The second is drawn from the cumulative weights with the interval of the first cut out
+    """
+    weights = np.asarray(weights, dtype=float)
+    if np.count_nonzero(weights) < 2:
+        raise ValueError("Fewer than 2 genomes with a non-zero weight")
+    cum_weights = np.cumsum(weights)
+    last = len(weights) - 1
+    first = np.minimum(np.searchsorted(cum_weights, np.random.rand(k) * cum_weights[-1], side='right'), last)
+    u = np.random.rand(k) * (cum_weights[-1] - weights[first])
+    u += np.where(u >= cum_weights[first] - weights[first], weights[first], 0)
+    second = np.minimum(np.searchsorted(cum_weights, u, side='right'), last)
+    # Rounding can land on the first or a genome without weight, move to the nearest valid one below
+    invalid = (second == first) | (weights[second] == 0)
+    while np.any(invalid):
+        second[invalid] -= 1
+        second[second < 0] = last
+        invalid = (second == first) | (weights[second] == 0)
+    return np.stack([first, second], axis=1)
+
+
+def order_by_score(evaluated_genomes, indices):
+    """ Swap couples whose second parent has the higher score, ties keep their order """
+    scores = np.array([s for g, s in evaluated_genomes])
+    swap = scores[indices[:, 1]] > scores[indices[:, 0]]
+    indices[swap] = indices[swap][:, ::-1]
+    return indices
+
 
 def cut_off_selection(evaluated_genomes, k, survival_threshold=0.4):
     """
@@ -13,9 +64,7 @@ def cut_off_selection(evaluated_genomes, k, survival_threshold=0.4):
     """
     n = len(evaluated_genomes)
     m = max(2, math.floor(survival_threshold * n))
-    indices = [random.sample(range(m), k=2) for _ in range(k)]
-    indices = [sorted(ind, key=lambda x: evaluated_genomes[x][1], reverse=True) for ind in indices]
-    return [list(map(lambda i: evaluated_genomes[ind[i]][0], [0, 1])) for ind in indices]
+    return order_by_score(evaluated_genomes, random_pairs(m, k))
 
 
 def tournament_selection(evaluated_genomes, k, tournament_size=4):
@@ -24,20 +73,16 @@ def tournament_selection(evaluated_genomes, k, tournament_size=4):
     """
     n = len(evaluated_genomes)
     tournament_size = max(2, min(n, tournament_size))
-    tournaments = [random.sample(range(n), k=tournament_size) for _ in range(k)]
-    return [list(map(lambda i: evaluated_genomes[sorted(t)[i]][0], [0, 1])) for t in tournaments]
+    tournaments = random_subsets(n, tournament_size, k)
+    return np.partition(tournaments, 1, axis=1)[:, :2]
 
 
 def fitness_proportionate_selection(evaluated_genomes, k):
     """
     Sample random couples weighted by their score
     """
-    n = len(evaluated_genomes)
     scores = [s for g, s in evaluated_genomes]
-    scores = np.array(scores) / sum(scores)
-    indices = [list(np.random.choice(range(n), size=2, p=scores, replace=False)) for _ in range(k)]
-    indices = [sorted(ind, key=lambda x: evaluated_genomes[x][1], reverse=True) for ind in indices]
-    return [list(map(lambda i: evaluated_genomes[ind[i]][0], [0, 1])) for ind in indices]
+    return order_by_score(evaluated_genomes, weighted_pairs(scores, k))
 
 
 def linear_ranking_selection(evaluated_genomes, k):
@@ -47,9 +92,7 @@ def linear_ranking_selection(evaluated_genomes, k):
     """
     n = len(evaluated_genomes)
     ranks = np.flip(np.arange(1, n+1))
-    indices = [list(np.random.choice(range(n), size=2, p=ranks/sum(ranks), replace=False)) for _ in range(k)]
-    indices = [sorted(ind, key=lambda x: evaluated_genomes[x][1], reverse=True) for ind in indices]
-    return [list(map(lambda i: evaluated_genomes[ind[i]][0], [0, 1])) for ind in indices]
+    return order_by_score(evaluated_genomes, weighted_pairs(ranks, k))
 
 
 def fitness_proportionate_tournament_selection(evaluated_genomes, k, tournament_size=3):
@@ -58,9 +101,10 @@ def fitness_proportionate_tournament_selection(evaluated_genomes, k, tournament_
     """
     n = len(evaluated_genomes)
     tournament_size = max(2, min(n, tournament_size))
-    indices = [np.random.choice(range(n), size=tournament_size, replace=False) for _ in range(k)]
-    indices = [sorted(ind, key=lambda x: evaluated_genomes[x][1], reverse=True) for ind in indices]
-    return [list(map(lambda i: evaluated_genomes[ind[i]][0], [0, 1])) for ind in indices]
+    tournaments = random_subsets(n, tournament_size, k)
+    scores = np.array([s for g, s in evaluated_genomes])
+    order = np.argsort(-scores[tournaments], axis=1, kind='stable')
+    return np.take_along_axis(tournaments, order[:, :2], axis=1)
 
 
 def stochastic_universal_sampling(evaluated_genomes, k, selection_percentage=0.3):
@@ -69,22 +113,21 @@ def stochastic_universal_sampling(evaluated_genomes, k, selection_percentage=0.3
     Does not avoid identical parents
     """
     # Quick fix for more offspring from mutation.
-    mutrate = 0.25
     muts = int(0.25 * k)
     nmuts = k - muts
 
     n = len(evaluated_genomes)
     m = max(2, math.floor(selection_percentage * n))
     scores = [s for g, s in evaluated_genomes]
-    step = sum(scores)/m
-    start = random.uniform(0, step)
     cum_scores = np.cumsum(scores)
-    parents = [evaluated_genomes[np.where(cum_scores > start + i*step)[0][0]][0] for i in range(m)]
-    indices = [random.sample(range(m), k=2) for _ in range(nmuts)]
+    step = cum_scores[-1] / m
+    pointers = np.random.uniform(0, step) + step * np.arange(m)
+    parents = np.minimum(np.searchsorted(cum_scores, pointers, side='right'), n - 1)
+    indices = random_pairs(m, nmuts)
 
     # Also mutation only
-    indices += [[i, i] for _ in range(muts) for i in random.sample(range(m), k=1)]
-    return [list(map(lambda i: parents[ind[i]], [0, 1])) for ind in indices]
+    indices = np.concatenate([indices, np.repeat(np.random.randint(m, size=(muts, 1)), 2, axis=1)])
+    return parents[indices]
 
 
 if __name__ == '__main__':
@@ -106,10 +149,20 @@ if __name__ == '__main__':
                 p = f(l, k=k)
                 for c in p:
                     for t in c:
-                        scores[t] += 1
+                        scores[l[t][0]] += 1
             pro = np.array(list(scores.values()))
             pro = pro/sum(pro)
             for pp in pro:
                 out += " %.2f" % pp
             out += " |"
         print(out, f.__name__)
+
+    # Breeding a big population
+    import time
+    for n in [1000, 10000]:
+        l = sorted([[i, np.random.rand()] for i in range(n)], key=lambda x: x[1], reverse=True)
+        for f in [cut_off_selection, tournament_selection, fitness_proportionate_selection,
+                  fitness_proportionate_tournament_selection, linear_ranking_selection, stochastic_universal_sampling]:
+            start = time.time()
+            f(l, k=n)
+            print("n = %5d | %8.2fms | %s" % (n, 1000 * (time.time() - start), f.__name__))
@@ -1,4 +1,8 @@
+import os
 import random
+import itertools
+import contextlib
+import tracemalloc
 import numpy as np
 import gc
 
@@ -18,6 +22,16 @@ def limited_growth(t, cap, relevance):
     return cap*(1-np.exp(-k*t))
 
 
+def feature_dissimilarity(features_1, features_2, importance, relevance, categorical=False):
+    """
+    Dissimilarity of hyperparameter vectors (broadcastable arrays), summed over the last axis
+    Numbers count by their absolute difference, categories only by whether they differ
+    """
+    dist = np.abs(features_1 - features_2)
+    dist = np.where(categorical, dist != 0, dist)
+    return np.sum(limited_growth(dist, importance, relevance), axis=-1)
+
+
 def score_decay(accuracy, training, decay_factor=0.01):
     """
     With increasing training linearly increase the log error [log(10, 1-acc)] on the data
@@ -26,9 +40,142 @@ def score_decay(accuracy, training, decay_factor=0.01):
     return max(1e-5, 1 - 10**(np.log10(1 - accuracy) + decay_factor * training))
 
 
+def cost_score(accuracy, training, measurements, weights, targets, decay_factor=0.01):
+    """
+    score_decay penalized for every measurement (e.g. latency, params, flops) over its target
+    score * (measurement / target) ** -weight, measurements that are None or have no weight are ignored
+    Always > 0
+    """
+    score = score_decay(accuracy, training, decay_factor=decay_factor)
+    for k, weight in weights.items():
+        value = measurements.get(k)
+        if weight > 0 and value is not None and value > targets[k]:
+            score *= (value / targets[k]) ** -weight
+    return max(1e-5, score)
+
+
+@contextlib.contextmanager
+def seeded(seed):
+    """
+    Seed random, NumPy and torch for the body and restore their state after it,
+    so the random numbers of the caller don't depend on what happens inside
+    """
+    state = random.getstate(), np.random.get_state(), torch.get_rng_state()
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    try:
+        yield
+    finally:
+        random.setstate(state[0])
+        np.random.set_state(state[1])
+        torch.set_rng_state(state[2])
+
+
+def process_rss():
+    """
+    Resident memory of this process in bytes, None if it can't be read (no /proc)
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def reset_rss_peak():
+    """
+    Reset the peak resident memory of this process (VmHWM) to the current RSS, False if it can't be reset
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def process_rss_peak():
+    """
+    Peak resident memory of this process in bytes since it started or reset_rss_peak,
+    from VmHWM in /proc or else from getrusage (never reset), None if neither can be read
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except (ImportError, OSError):
+        return None
+
+
+class MemoryTracker:
+    """
+    Peak memory between start and stop, read from cheap counters
+    cuda: the peak allocated by torch's caching allocator (only if cuda is already in use)
+    cpu:  the peak RSS of the process kept by the kernel (VmHWM, reset at start), so the peak of forward and
+          backward passes is included. Where it can't be reset, the kernel peak only counts if it was reached
+          after start, else the peak of the RSS at start and every sample.
+          The peak of python allocations if tracemalloc is tracing (trace_python starts it, it slows down python
+          allocations)
+    """
+
+    def __init__(self, trace_python=False):
+        self.trace_python = trace_python
+        self.cuda = torch.cuda.is_available() and torch.cuda.is_initialized()
+        self.rss_peak = None
+        self.process_peak = None
+
+    def start(self):
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats()
+        if self.trace_python and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        self.rss_peak = process_rss()
+        # The peak before start, 0 if it was reset (every new peak counts)
+        self.process_peak = 0 if reset_rss_peak() else process_rss_peak()
+        return self
+
+    def sample(self):
+        rss = process_rss()
+        if rss is not None:
+            self.rss_peak = max(self.rss_peak or 0, rss)
+
+    def stop(self):
+        """ Returns the peaks in bytes """
+        self.sample()
+        process_peak = process_rss_peak()
+        if process_peak is not None and self.process_peak is not None and process_peak > self.process_peak:
+            self.rss_peak = max(self.rss_peak or 0, process_peak)
+        memory = {'rss_peak': self.rss_peak}
+        if self.cuda:
+            memory['cuda_peak'] = torch.cuda.max_memory_allocated()
+        if tracemalloc.is_tracing():
+            memory['python_peak'] = tracemalloc.get_traced_memory()[1]
+        return memory
+
+
+class SyntheticPopulation:
+    """ Just enough of a Population to mutate genomes, for benchmarks """
+
+    def __init__(self):
+        self.id_generator = itertools.count(5)
+
+    def next_id(self):
+        return next(self.id_generator)
+
+
 def check_cuda_memory():
     """
     Compiles a list of allocated Torch Tensors on the device
+    Walks all python objects, only for hunting leaks (see MemoryTracker for cheap statistics)
     """
     tensor_list = []
     for obj in gc.get_objects():